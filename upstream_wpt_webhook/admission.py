@@ -0,0 +1,182 @@
+# Limits how many deliveries a worker processes at once and how many may wait
+# for their turn. When the queue fills up, the least valuable events are turned
+# away first: title edits, then pushes, while merges and closes, whose upstream
+# effect can't be recreated by a later event, are accepted until the queue is
+# completely full. Within a class, waiting events are ordered by weighted fair
+# queuing across PRs, so that a PR receiving a stream of pushes can't starve
+# the others. Events for the same PR are always processed one at a time, in the
+# order they arrived.
+
+from contextlib import contextmanager
+import itertools
+import threading
+import time
+
+MAX_IN_FLIGHT = 4
+MAX_QUEUED = 32
+RETRY_AFTER = 60
+
+# Event classes from most to least valuable, and the fraction of the queue
+# each may fill before further events of that class are shed.
+EVENT_CLASSES = ['merge', 'close', 'push', 'edit']
+QUEUE_SHARE = {
+    'merge': 1.0,
+    'close': 1.0,
+    'push': 0.75,
+    'edit': 0.5,
+}
+
+
+# Pushes are weighted by the number of commits to export; other events do a
+# handful of API requests each.
+MAX_PUSH_COST = 50
+
+
+def classify(payload):
+    action = payload.get('action')
+    if action == 'closed':
+        return 'merge' if payload['pull_request'].get('merged') else 'close'
+    if action in ['opened', 'synchronize', 'reopened']:
+        return 'push'
+    return 'edit'
+
+
+def cost(payload, event_class):
+    if event_class != 'push':
+        return 1
+    return max(1, min(payload['pull_request'].get('commits', 1), MAX_PUSH_COST))
+
+
+class Saturated(Exception):
+    def __init__(self, event_class, full):
+        Exception.__init__(self, 'not accepting %s events' % event_class)
+        self.event_class = event_class
+        # Whether no event of any class would have been accepted.
+        self.full = full
+
+
+class AdmissionController:
+    def __init__(self, config):
+        self.max_in_flight = config.get('max_in_flight', MAX_IN_FLIGHT)
+        self.max_queued = config.get('max_queued', MAX_QUEUED)
+        self.condition = threading.Condition()
+        self.in_flight = 0
+        self.waiting = []
+        # Number of events being processed for each PR.
+        self.in_flight_prs = {}
+        self.sequence = itertools.count()
+        # Self-clocked fair queuing: each class's virtual time is the finish
+        # tag of the last event it admitted, and each PR's next event finishes
+        # its cost after the later of that and the PR's previous finish tag.
+        self.virtual_time = dict((event_class, 0) for event_class in EVENT_CLASSES)
+        self.last_finish = dict((event_class, {}) for event_class in EVENT_CLASSES)
+        self.waits = dict((event_class, {'admitted': 0, 'total': 0.0, 'max': 0.0})
+                          for event_class in EVENT_CLASSES)
+
+    def _finish_tag(self, event_class, pr_number, cost):
+        last_finish = self.last_finish[event_class]
+        finish = max(self.virtual_time[event_class], last_finish.get(pr_number, 0)) + cost
+        last_finish[pr_number] = finish
+        return finish
+
+    def _record_admission(self, entry, waited):
+        event_class = EVENT_CLASSES[entry[0]]
+        self.virtual_time[event_class] = entry[1]
+        # PRs that have fallen behind the virtual time get no credit for it.
+        last_finish = self.last_finish[event_class]
+        for pr_number in [pr for pr in last_finish if last_finish[pr] <= entry[1]]:
+            del last_finish[pr_number]
+        waits = self.waits[event_class]
+        waits['admitted'] += 1
+        waits['total'] += waited
+        waits['max'] = max(waits['max'], waited)
+
+    def _next(self):
+        """The waiting event to admit next. Events for the same PR are admitted
+        one at a time in arrival order, so the first waiting event of each PR
+        stands in for all of them, with the priority of the most valuable."""
+        heads = {}
+        priorities = {}
+        for entry in self.waiting:
+            # Events without a PR number are independent of each other.
+            pr = entry[3] if entry[3] is not None else ('event', entry[2])
+            if pr in self.in_flight_prs:
+                continue
+            if pr not in heads or entry[2] < heads[pr][2]:
+                heads[pr] = entry
+            if pr not in priorities or entry[:2] < priorities[pr]:
+                priorities[pr] = entry[:2]
+        if not heads:
+            return None
+        pr = min(heads, key=lambda pr: (priorities[pr], heads[pr][2]))
+        return heads[pr]
+
+    @contextmanager
+    def admitted(self, event_class, pr_number=None, cost=1, accepted=None):
+        """Wait for a slot to process an event of the given class, raising
+        Saturated if it should be shed instead. Waiting events are let in most
+        valuable first, and fairly between PRs within a class, but never ahead
+        of an earlier event for the same PR. accepted() is called once the
+        event is known not to be shed, before waiting for a slot."""
+        with self.condition:
+            if self.in_flight >= self.max_in_flight or self.waiting:
+                if len(self.waiting) >= self.max_queued * QUEUE_SHARE[event_class]:
+                    raise Saturated(event_class, len(self.waiting) >= self.max_queued)
+            entry = (EVENT_CLASSES.index(event_class),
+                     self._finish_tag(event_class, pr_number, cost),
+                     next(self.sequence),
+                     pr_number)
+            queued_at = time.time()
+            self.waiting.append(entry)
+        try:
+            if accepted:
+                accepted()
+            with self.condition:
+                while self.in_flight >= self.max_in_flight or self._next() != entry:
+                    self.condition.wait()
+                self.waiting.remove(entry)
+                self.in_flight += 1
+                if pr_number is not None:
+                    self.in_flight_prs[pr_number] = self.in_flight_prs.get(pr_number, 0) + 1
+                self._record_admission(entry, time.time() - queued_at)
+        except:
+            with self.condition:
+                if entry in self.waiting:
+                    self.waiting.remove(entry)
+                    self.condition.notify_all()
+            raise
+        try:
+            yield
+        finally:
+            with self.condition:
+                self.in_flight -= 1
+                if pr_number is not None:
+                    self.in_flight_prs[pr_number] -= 1
+                    if not self.in_flight_prs[pr_number]:
+                        del self.in_flight_prs[pr_number]
+                self.condition.notify_all()
+
+    def ready(self):
+        with self.condition:
+            return self.in_flight < self.max_in_flight or len(self.waiting) < self.max_queued
+
+    def stats(self):
+        with self.condition:
+            queued = dict((event_class, 0) for event_class in EVENT_CLASSES)
+            for entry in self.waiting:
+                queued[EVENT_CLASSES[entry[0]]] += 1
+            wait = {}
+            for (event_class, waits) in self.waits.items():
+                wait[event_class] = {
+                    'admitted': waits['admitted'],
+                    'queued': queued[event_class],
+                    'mean': waits['total'] / waits['admitted'] if waits['admitted'] else 0.0,
+                    'max': waits['max'],
+                }
+            return {
+                'in_flight': self.in_flight,
+                'queued': len(self.waiting),
+                'max_in_flight': self.max_in_flight,
+                'max_queued': self.max_queued,
+                'wait': wait,
+            }
@@ -0,0 +1,72 @@
+import requests
+from cancellation import TimedOut, check_cancelled, remaining_time
+from circuit_breaker import record_failure, record_success
+from profiling import timed
+from recording import current_player, record_http
+try:
+    import urlparse
+except ImportError:
+    from urllib import parse as urlparse
+
+# Default upper bound in seconds on any single API request.
+HTTP_TIMEOUT = 60
+
+
+def request_timeout(config):
+    """Timeout for the next request: the per-request limit, or whatever is
+    left of the current event's deadline if that is sooner."""
+    timeout = config.get('http_timeout', HTTP_TIMEOUT)
+    remaining = remaining_time()
+    if remaining is not None:
+        timeout = min(timeout, remaining)
+    return timeout
+
+
+def _request(config, session, method, url, json):
+    print('fetching %s' % url)
+    with timed('http', '%s %s' % (method, url)):
+        try:
+            response = session.request(method, url, json=json, timeout=request_timeout(config))
+        except requests.exceptions.Timeout:
+            record_failure(config)
+            raise TimedOut('%s %s timed out' % (method, url))
+        except requests.exceptions.ConnectionError:
+            record_failure(config)
+            raise
+    # Client errors are our own fault rather than a sign that GitHub is unwell.
+    if response.status_code >= 500 or response.status_code == 429:
+        record_failure(config)
+    else:
+        record_success(config)
+    return response
+
+
+def authenticated(config, method, url, json=None, headers=None):
+    s = requests.Session()
+    if not method:
+        method = 'GET'
+    s.headers = {
+        'Authorization': 'token %s' % config['token'],
+        'User-Agent': 'Servo web-platform-test sync service',
+    }
+    # Conditional requests answer 304 Not Modified when nothing has changed.
+    allowed = [304] if headers and 'If-None-Match' in headers else []
+    if headers:
+        s.headers.update(headers)
+    requested_url = url
+    if 'override_host' in config:
+        # Ensure that any URLs retrieved are rewritten to use the overriden host
+        partial = urlparse.urlsplit(url)
+        url = partial[2] + partial[3] + partial[4]
+
+    url = urlparse.urljoin(config['api'], url)
+    check_cancelled()
+    player = current_player()
+    if player:
+        response = player.http(method, requested_url, json)
+    else:
+        response = _request(config, s, method, url, json)
+    record_http(method, requested_url, json, response)
+    if int(response.status_code / 100) != 2 and response.status_code not in allowed:
+        raise ValueError('got unexpected %d response: %s' % (response.status_code, response.text))
+    return response
@@ -0,0 +1,72 @@
+# The Servo and web-platform-tests clones are created in the background so
+# that the server can accept (and spool) deliveries immediately on a fresh
+# node. Clones are blobless by default, fetching file contents only when they
+# are needed, and can borrow objects from a local cache with
+# config['clone_reference'].
+
+import os
+import shutil
+import threading
+import time
+from state import repo_lock
+from sync import git
+
+REPOSITORIES = [
+    ('wpt_path', 'https://github.com/w3c/web-platform-tests.git'),
+    ('servo_path', 'https://github.com/servo/servo.git'),
+]
+CLONE_FILTER = 'blob:none'
+RETRY_INTERVAL = 60
+
+_pending = threading.Event()
+
+
+def bootstrapped():
+    """Whether the clones are usable (always true if no background bootstrap
+    was started, as the clones are then assumed to exist)."""
+    return not _pending.is_set()
+
+
+def clone_args(config, url, path):
+    args = ["clone"]
+    if config.get('clone_filter', CLONE_FILTER):
+        args += ["--filter=" + config.get('clone_filter', CLONE_FILTER)]
+    if config.get('clone_reference'):
+        args += ["--reference-if-able", config['clone_reference']]
+    return args + [url, path]
+
+
+def clone_repositories(config):
+    for (key, url) in REPOSITORIES:
+        # Several workers may start at once; only the first one should clone.
+        with repo_lock(config[key]):
+            if os.path.isdir(config[key]):
+                continue
+            # Clone next to the final location so that an interrupted clone is
+            # never mistaken for a usable one.
+            tmp_path = config[key].rstrip(os.sep) + '.partial'
+            if os.path.isdir(tmp_path):
+                shutil.rmtree(tmp_path)
+            git(clone_args(config, url, tmp_path), cwd='.')
+            os.rename(tmp_path, config[key])
+
+
+def start_bootstrap(config, on_ready=None):
+    _pending.set()
+
+    def run():
+        while True:
+            try:
+                clone_repositories(config)
+                break
+            except Exception as e:
+                print('error cloning repositories: %s' % e)
+                time.sleep(RETRY_INTERVAL)
+        _pending.clear()
+        print('repositories ready')
+        if on_ready:
+            on_ready()
+    thread = threading.Thread(target=run)
+    thread.daemon = True
+    thread.start()
+    return thread
@@ -0,0 +1,123 @@
+from contextlib import contextmanager
+import os
+import signal
+import sys
+import threading
+import time
+
+# How often a running subprocess checks whether it should be killed.
+POLL_INTERVAL = 0.5
+# How long cleanup that must run after cancellation is given to complete.
+CLEANUP_TIMEOUT = 60
+
+_current = threading.local()
+
+
+class Cancelled(Exception):
+    pass
+
+
+class TimedOut(Cancelled):
+    pass
+
+
+class CancellationToken:
+    """Cancelled explicitly, when is_cancelled() returns true, or once the
+    deadline (a time.time() value) has passed."""
+    def __init__(self, is_cancelled=None, deadline=None):
+        self._is_cancelled = is_cancelled
+        self._cancelled = False
+        self.deadline = deadline
+
+    def cancel(self):
+        self._cancelled = True
+
+    def remaining(self):
+        if self.deadline is None:
+            return None
+        return max(0, self.deadline - time.time())
+
+    def timed_out(self):
+        return self.deadline is not None and time.time() >= self.deadline
+
+    def cancelled(self):
+        if not self._cancelled and self._is_cancelled:
+            self._cancelled = self._is_cancelled()
+        return self._cancelled or self.timed_out()
+
+    def check(self):
+        if self.timed_out():
+            raise TimedOut()
+        if self.cancelled():
+            raise Cancelled()
+
+
+def current_token():
+    return getattr(_current, 'token', None)
+
+
+def check_cancelled():
+    token = current_token()
+    if token:
+        token.check()
+
+
+def remaining_time():
+    """Seconds left before the current run's deadline, or None."""
+    token = current_token()
+    return token.remaining() if token else None
+
+
+@contextmanager
+def cancellable(token):
+    previous = current_token()
+    _current.token = token
+    try:
+        yield
+    finally:
+        _current.token = previous
+
+
+def uncancellable(timeout=CLEANUP_TIMEOUT):
+    # Used for cleanup that must run even after cancellation, but which still
+    # must not hang forever.
+    return cancellable(CancellationToken(deadline=time.time() + timeout))
+
+
+# Keyword arguments to subprocess.Popen that start the child in a new session,
+# and so a new process group. preexec_fn isn't safe in a threaded server, so it
+# is only used where start_new_session doesn't exist.
+if sys.version_info[0] >= 3:
+    NEW_PROCESS_GROUP = {'start_new_session': True}
+else:
+    NEW_PROCESS_GROUP = {'preexec_fn': os.setsid}
+
+
+@contextmanager
+def kill_on_cancel(process):
+    """Kill the subprocess if the current run is cancelled while it runs, then
+    raise Cancelled once it has exited. The process should lead its own process
+    group (see NEW_PROCESS_GROUP) so that helpers it spawned, such as
+    git-remote-https, are killed with it."""
+    token = current_token()
+    if token is None:
+        yield
+        return
+    done = threading.Event()
+
+    def watch():
+        while not done.wait(POLL_INTERVAL):
+            if token.cancelled():
+                try:
+                    os.killpg(process.pid, signal.SIGKILL)
+                except OSError:
+                    pass
+                return
+    watcher = threading.Thread(target=watch)
+    watcher.daemon = True
+    watcher.start()
+    try:
+        yield
+    finally:
+        done.set()
+    token.check()
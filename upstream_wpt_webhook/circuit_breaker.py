@@ -0,0 +1,105 @@
+# When GitHub (or our fork of web-platform-tests) is failing, processing more
+# deliveries only produces more failures and error comments. After
+# config['breaker_threshold'] consecutive failures of API requests or remote git
+# operations the breaker opens, and deliveries are spooled (see spool.py). Once
+# a health check succeeds it is half-open: the oldest spooled delivery is
+# replayed, and the breaker only closes if that doesn't fail again; successful
+# requests made by anything else don't close it. The state is shared between
+# workers through the state directory. The breaker is only used if
+# config['circuit_breaker'] is set.
+
+from contextlib import contextmanager
+import time
+from cancellation import Cancelled, TimedOut
+from state import json_lock, read_json, write_json
+
+BREAKER_FILE = 'breaker.json'
+BREAKER_THRESHOLD = 5
+BREAKER_COOLDOWN = 60
+
+
+def breaker_enabled(config):
+    return config.get('circuit_breaker', False)
+
+
+def _breaker_state(config):
+    return read_json(config, BREAKER_FILE)
+
+
+def _tripped(config, state):
+    return state.get('failures', 0) >= config.get('breaker_threshold', BREAKER_THRESHOLD)
+
+
+def breaker_open(config):
+    """Whether deliveries must not be processed; false while half-open."""
+    if not breaker_enabled(config):
+        return False
+    state = _breaker_state(config)
+    return _tripped(config, state) and not state.get('half_open')
+
+
+def breaker_cooled_down(config):
+    """Whether an open breaker has waited long enough to try a health check."""
+    state = _breaker_state(config)
+    return time.time() - state.get('opened_at', 0) >= config.get('breaker_cooldown', BREAKER_COOLDOWN)
+
+
+def record_failure(config):
+    if not breaker_enabled(config):
+        return
+    with json_lock(config, BREAKER_FILE):
+        state = _breaker_state(config)
+        state['failures'] = state.get('failures', 0) + 1
+        if _tripped(config, state):
+            if state.pop('half_open', False):
+                print('circuit breaker re-opened')
+            elif state['failures'] == config.get('breaker_threshold', BREAKER_THRESHOLD):
+                print('circuit breaker opened')
+            state['opened_at'] = time.time()
+        write_json(config, BREAKER_FILE, state)
+
+
+def record_success(config):
+    if not breaker_enabled(config):
+        return
+    # Avoid taking the lock and rewriting the file on the common path.
+    if not _breaker_state(config).get('failures'):
+        return
+    with json_lock(config, BREAKER_FILE):
+        # Only a successfully replayed delivery closes a tripped breaker (see
+        # close_breaker).
+        if not _tripped(config, _breaker_state(config)):
+            write_json(config, BREAKER_FILE, {})
+
+
+def half_open_breaker(config):
+    """Let a single spooled delivery be replayed to see whether GitHub has
+    recovered."""
+    with json_lock(config, BREAKER_FILE):
+        state = _breaker_state(config)
+        if _tripped(config, state):
+            state['half_open'] = True
+            write_json(config, BREAKER_FILE, state)
+
+
+def close_breaker(config):
+    with json_lock(config, BREAKER_FILE):
+        if _tripped(config, _breaker_state(config)):
+            print('circuit breaker closed')
+        write_json(config, BREAKER_FILE, {})
+
+
+@contextmanager
+def remote_operation(config):
+    """Record the outcome of a git operation that talks to a remote."""
+    try:
+        yield
+    except TimedOut:
+        record_failure(config)
+        raise
+    except Cancelled:
+        raise
+    except Exception:
+        record_failure(config)
+        raise
+    record_success(config)
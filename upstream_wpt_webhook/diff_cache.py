@@ -0,0 +1,131 @@
+# Filtered diffs of a commit can never change, so they are cached on disk
+# (gzipped, keyed by commit sha and the filtered path) under
+# config['diff_cache_path'], and the least recently used entries are evicted
+# once the cache grows beyond config['diff_cache_size'] bytes. A commit with no
+# upstreamable changes is cached as an empty diff.
+
+import errno
+import gzip
+import hashlib
+import os
+import shutil
+import tempfile
+import threading
+from spooled import CHUNK_SIZE, spooled_file
+
+DIFF_CACHE_SIZE = 1024 * 1024 * 1024
+RESCAN_INTERVAL = 100
+
+_usage = {}
+_usage_lock = threading.Lock()
+
+
+def cache_enabled(config):
+    return 'diff_cache_path' in config
+
+
+def _cache_file(config, commit, path):
+    key = hashlib.sha1(('%s\0%s' % (commit, path)).encode('utf-8')).hexdigest()
+    return os.path.join(config['diff_cache_path'], key[:2], key + '.gz')
+
+
+def read_cached_diff(config, commit, path, max_size=0):
+    """Returns the cached diff as a spooled temporary file, or None."""
+    filename = _cache_file(config, commit, path)
+    try:
+        f = gzip.open(filename, 'rb')
+    except (IOError, OSError):
+        return None
+    out = spooled_file(max_size)
+    try:
+        with f:
+            shutil.copyfileobj(f, out, CHUNK_SIZE)
+        # Mark the entry as recently used.
+        os.utime(filename, None)
+    except (IOError, OSError, EOFError):
+        # Evicted or truncated underneath us; treat it as a miss.
+        out.close()
+        return None
+    out.seek(0)
+    return out
+
+
+def write_cached_diff(config, commit, path, diff):
+    """Cache the diff, if possible; failing to do so doesn't fail the sync."""
+    filename = _cache_file(config, commit, path)
+    tmp_filename = None
+    try:
+        try:
+            os.makedirs(os.path.dirname(filename))
+        except OSError as e:
+            if e.errno != errno.EEXIST:
+                raise
+        # Unique per writer, as other threads may be caching the same commit.
+        (fd, tmp_filename) = tempfile.mkstemp(suffix='.tmp', dir=os.path.dirname(filename))
+        diff.seek(0)
+        with os.fdopen(fd, 'wb') as raw:
+            with gzip.GzipFile(fileobj=raw, mode='wb') as f:
+                shutil.copyfileobj(diff, f, CHUNK_SIZE)
+        size = os.path.getsize(tmp_filename)
+        os.rename(tmp_filename, filename)
+        tmp_filename = None
+        _account(config, size)
+    except (IOError, OSError) as e:
+        print('error caching diff of %s: %s' % (commit, e))
+        if tmp_filename:
+            try:
+                os.remove(tmp_filename)
+            except OSError:
+                pass
+    finally:
+        diff.seek(0)
+
+
+def _account(config, size):
+    # Each worker keeps a running estimate of the cache's size, and only walks
+    # the cache when that exceeds the limit or, to catch up with writes made by
+    # other workers, every RESCAN_INTERVAL writes.
+    cache_path = config['diff_cache_path']
+    limit = config.get('diff_cache_size', DIFF_CACHE_SIZE)
+    with _usage_lock:
+        usage = _usage.get(cache_path)
+        if usage is not None and usage['writes'] < RESCAN_INTERVAL:
+            usage['size'] += size
+            usage['writes'] += 1
+            if usage['size'] <= limit:
+                return
+    total = _evict(config)
+    with _usage_lock:
+        _usage[cache_path] = {'size': total, 'writes': 0}
+
+
+def _evict(config):
+    """Evict the least recently used entries if the cache is over its limit,
+    returning its size afterwards."""
+    limit = config.get('diff_cache_size', DIFF_CACHE_SIZE)
+    entries = []
+    total = 0
+    for (dirpath, _, filenames) in os.walk(config['diff_cache_path']):
+        for filename in filenames:
+            if not filename.endswith('.gz'):
+                continue
+            filename = os.path.join(dirpath, filename)
+            try:
+                stat = os.stat(filename)
+            except OSError:
+                continue
+            entries += [(stat.st_mtime, stat.st_size, filename)]
+            total += stat.st_size
+    if total <= limit:
+        return total
+    # Evict down to 90% of the limit so that we don't walk the cache again on
+    # every subsequent write.
+    for (_, size, filename) in sorted(entries):
+        if total <= limit * 0.9:
+            break
+        try:
+            os.remove(filename)
+        except OSError:
+            pass
+        total -= size
+    return total
@@ -0,0 +1,123 @@
+# Optional GraphQL implementations of the upstream PR operations, enabled by
+# config['graphql']. Node ids of the upstream repository, its labels and the
+# PRs we touch never change, so they are cached for the life of the process;
+# with a warm cache, merging (label removal plus merge) takes a single request.
+# GitHub's createPullRequest can't set labels and a mutation can't refer to an
+# earlier one's result, so opening a PR still takes two.
+
+from api import authenticated
+from cancellation import TimedOut
+from recording import current_player, record_node_ids
+import requests
+
+_node_ids = {}
+
+
+def _cache():
+    # A replay must make the same queries as the recorded sync did, whatever
+    # this process has cached; the player holds the ids that were cached then.
+    player = current_player()
+    return player.node_ids if player else _node_ids
+
+
+class Unavailable(Exception):
+    """The GraphQL endpoint could not be used; callers fall back to REST."""
+    pass
+
+
+def graphql(config, document, variables):
+    try:
+        r = authenticated(config, 'POST', 'graphql',
+                          json={'query': document, 'variables': variables})
+    except (ValueError, TimedOut, requests.exceptions.RequestException) as e:
+        # If the event's own deadline has passed, the REST fallback will time
+        # out straight away too.
+        raise Unavailable(str(e))
+    result = r.json()
+    if result.get('errors'):
+        raise ValueError('GraphQL request failed: %s' % result['errors'])
+    return result['data']
+
+
+def _upstream_ids(config, pr_number=None, labels=[]):
+    """Look up (and cache) the node ids of the upstream repository, the given
+    PR and labels, fetching any that are missing in a single query."""
+    org = config['upstream_org']
+    repo_key = (org, 'repository')
+    pr_key = (org, 'pr', int(pr_number or 0))
+    label_keys = [(org, 'label', label) for label in labels]
+    node_ids = _cache()
+    keys = [repo_key] + ([pr_key] if pr_number is not None else []) + label_keys
+    record_node_ids(cached=dict((key, node_ids[key]) for key in keys if key in node_ids))
+    need_pr = pr_number is not None and pr_key not in node_ids
+    missing_labels = [key for key in label_keys if key not in node_ids]
+
+    if repo_key not in node_ids or need_pr or missing_labels:
+        variables = {
+            'owner': org,
+            'name': 'web-platform-tests',
+            'number': pr_key[2],
+            'withPr': need_pr,
+        }
+        label_fields = ''
+        label_params = ''
+        for (i, key) in enumerate(missing_labels):
+            variables['label%d' % i] = key[2]
+            label_params += ', $label%d: String!' % i
+            label_fields += ' label%d: label(name: $label%d) { id }' % (i, i)
+        document = ('query($owner: String!, $name: String!, $number: Int!, $withPr: Boolean!%s) {'
+                    ' repository(owner: $owner, name: $name) { id'
+                    ' pullRequest(number: $number) @include(if: $withPr) { id }%s } }' %
+                    (label_params, label_fields))
+        repository = graphql(config, document, variables)['repository']
+        node_ids[repo_key] = repository['id']
+        if need_pr:
+            node_ids[pr_key] = repository['pullRequest']['id']
+        for (i, key) in enumerate(missing_labels):
+            if not repository['label%d' % i]:
+                raise ValueError('no such label: %s' % key[2])
+            node_ids[key] = repository['label%d' % i]['id']
+        record_node_ids(fetched=[repo_key] + ([pr_key] if need_pr else []) + missing_labels)
+
+    return (node_ids[repo_key],
+            node_ids[pr_key] if pr_number is not None else None,
+            [node_ids[key] for key in label_keys])
+
+
+def create_pull_request(config, title, head, body, labels=[]):
+    # Look up the ids of any labels that will be added next alongside the
+    # repository id, so that add_labels doesn't need a query of its own.
+    repository_id, _, _ = _upstream_ids(config, labels=labels)
+    document = ('mutation($input: CreatePullRequestInput!) {'
+                ' createPullRequest(input: $input) { pullRequest { id number url } } }')
+    data = graphql(config, document, {'input': {
+        'repositoryId': repository_id,
+        'title': title,
+        'headRefName': head,
+        'baseRefName': 'master',
+        'body': body,
+        'maintainerCanModify': False,
+    }})
+    pull_request = data['createPullRequest']['pullRequest']
+    pr_key = (config['upstream_org'], 'pr', pull_request['number'])
+    _cache()[pr_key] = pull_request['id']
+    record_node_ids(fetched=[pr_key])
+    return pull_request['number'], pull_request['url']
+
+
+def add_labels(config, pr_number, labels):
+    _, pr_id, label_ids = _upstream_ids(config, pr_number, labels)
+    document = ('mutation($input: AddLabelsToLabelableInput!) {'
+                ' addLabelsToLabelable(input: $input) { clientMutationId } }')
+    graphql(config, document, {'input': {'labelableId': pr_id, 'labelIds': label_ids}})
+
+
+def merge_pull_request(config, pr_number, remove_labels):
+    _, pr_id, label_ids = _upstream_ids(config, pr_number, remove_labels)
+    document = ('mutation($labels: RemoveLabelsFromLabelableInput!, $merge: MergePullRequestInput!) {'
+                ' removeLabelsFromLabelable(input: $labels) { clientMutationId }'
+                ' mergePullRequest(input: $merge) { clientMutationId } }')
+    graphql(config, document, {
+        'labels': {'labelableId': pr_id, 'labelIds': label_ids},
+        'merge': {'pullRequestId': pr_id, 'mergeMethod': 'REBASE'},
+    })
@@ -6,25 +6,29 @@ sys.path.append(os.path.abspath(os.path.dirname(__file__)))
 
 from flask import Flask, request, jsonify, render_template, make_response, abort
 from functools import partial
-from sync import process_and_run_steps, _do_comment_on_pr, modify_upstream_pr_labels, git, UPSTREAMABLE_PATH, fetch_upstream_branch
+from sync import process_and_run_steps, _do_comment_on_pr, modify_upstream_pr_labels, git, UPSTREAMABLE_PATH, fetch_upstream_branch, UPSTREAM_ERROR_BODY
+from admission import AdmissionController, Saturated, classify, cost, RETRY_AFTER
+from api import request_timeout
+from cancellation import CancellationToken, TimedOut, check_cancelled
+from bootstrap import bootstrapped, start_bootstrap
+from circuit_breaker import breaker_enabled, breaker_open
+from merge_queue import poke_merge_queue, start_merge_scheduler
+from profiling import profiling_enabled, run_profiled
+from recording import Recorder, recording_enabled
+from spool import should_spool, spool_delivery, start_spool_drainer
+from state import pr_generation, pr_lock, read_pr_db, supersede_pr, update_pr_db
 import json
 import requests
 
 app = Flask(__name__)
 config = None
 pr_db = None
+admission = None
 
 @app.route("/")
 def index():
     return "Hi!"
 
-def read_pr_db():
-    try:
-        with open('pr_map.json') as f:
-            return json.loads(f.read())
-    except:
-        return {}
-
 def read_config():
     with open('config.json') as f:
         config = json.loads(f.read())
@@ -39,40 +43,133 @@ def read_config():
         return config
 
 def get_pr_diff(pull_request):
-    return requests.get(pull_request["diff_url"]).text
+    check_cancelled()
+    try:
+        return requests.get(pull_request["diff_url"], timeout=request_timeout(config)).text
+    except requests.exceptions.Timeout:
+        raise TimedOut('fetching %s timed out' % pull_request["diff_url"])
 
 ERROR_BODY = "Error syncing changes upstream. Logs saved in %s."
-UPSTREAM_ERROR_BODY = "Error merging pull request automatically. Please merge manually after addressing any CI issues."
 
 def error_callback(config, payload, pr_db, dir_name):
+    if breaker_open(config):
+        # Commenting would only add to the failing requests, and the delivery
+        # will be retried from the spool.
+        return
     _do_comment_on_pr(config, payload["pull_request"]["number"], ERROR_BODY % dir_name)
     if 'action' in payload and payload['action'] == 'closed' and payload['pull_request']['merged']:
-        pr_number = pr_db[payload["pull_request"]["number"]]
+        pr_number = pr_db[str(payload["pull_request"]["number"])]
         modify_upstream_pr_labels(config, 'POST', ['stale-sevo-export'], pr_number)
         _do_comment_on_pr(config, pr_number, UPSTREAM_ERROR_BODY)
 
 
-def _webhook_impl(pr_db, dry_run):
-    payload = request.form.get('payload', '{}')
-    payload = json.loads(payload)
+# Events that make any in-flight sync of the same PR obsolete, and the events
+# whose syncs may be abandoned when that happens. A merge doesn't redo the
+# sync's work, so it waits for the sync to finish instead.
+SUPERSEDING_ACTIONS = ['synchronize', 'closed']
+CANCELLABLE_ACTIONS = ['opened', 'synchronize', 'reopened']
+
+def supersedes(payload):
+    if payload.get('action') == 'closed':
+        return not payload['pull_request'].get('merged')
+    return payload.get('action') in SUPERSEDING_ACTIONS
+
+def _process_payload(payload, pr_db, dry_run, cancel_token=None, profile=False, record=False):
     error = partial(error_callback, config, payload, pr_db) if not dry_run else None
     if dry_run:
         branch_name = "master"
     else:
         branch_name = "pull/%s/head" % payload["pull_request"]["number"]
-    result = process_and_run_steps(config, pr_db, payload, get_pr_diff, branch_name,
-                                   error_callback=error)
+    provider = get_pr_diff
+    recorder = Recorder(config) if record else None
+    if recorder:
+        provider = recorder.provider(provider)
+    run = partial(process_and_run_steps, config, pr_db, payload, provider, branch_name,
+                  error_callback=error, cancel_token=cancel_token)
+    if recorder:
+        run = partial(recorder.record, payload, pr_db, branch_name, run)
+    if profile:
+        return run_profiled(config, payload, run)
+    return run()
+
+def _webhook_impl(pr_db, dry_run):
+    payload = request.form.get('payload', '{}')
+    payload = json.loads(payload)
+    result = _process_payload(payload, pr_db, dry_run,
+                              profile=profiling_enabled(config, request.headers),
+                              record=recording_enabled(config, request.headers))
     if not result:
         return ('', 500)
-
-    if not dry_run:
-        with open('pr_map.json', 'w') as f:
-            f.write(json.dumps(pr_db))
     return ('', 204)
 
+def delivery_token(payload):
+    """Supersede any in-flight sync that this delivery makes obsolete, and
+    return the token that cancels this delivery's own sync once a later one
+    supersedes it (None if it can't be cancelled)."""
+    pr_number = str(payload["pull_request"]["number"])
+    if supersedes(payload):
+        generation = supersede_pr(config, pr_number)
+    else:
+        generation = pr_generation(config, pr_number)
+    if payload.get('action') in CANCELLABLE_ACTIONS:
+        return CancellationToken(lambda: pr_generation(config, pr_number) > generation)
+    return None
+
+def process_delivery(payload, profile=False, record=False, tokens=None):
+    pr_number = str(payload["pull_request"]["number"])
+    cancel_token = tokens[0] if tokens else delivery_token(payload)
+    # Other workers (possibly on other nodes) may be handling events for other
+    # PRs concurrently; only one may touch this PR's upstream state at a time.
+    with pr_lock(config, pr_number):
+        pr_db = read_pr_db(config)
+        try:
+            return _process_payload(payload, pr_db, False, cancel_token, profile, record)
+        finally:
+            update_pr_db(config, pr_number, pr_db.get(pr_number))
+
 @app.route("/hook", methods=["POST"])
 def webhook():
-    return _webhook_impl(pr_db, False)
+    payload = json.loads(request.form.get('payload', '{}'))
+    if not bootstrapped() or should_spool(config):
+        spool_delivery(config, payload)
+        return ('', 202)
+    try:
+        event_class = classify(payload)
+        # Supersede older syncs of the PR as soon as the delivery is accepted,
+        # rather than once it has waited its turn behind them.
+        tokens = []
+        with admission.admitted(event_class, payload['pull_request']['number'],
+                                cost(payload, event_class),
+                                accepted=lambda: tokens.append(delivery_token(payload))):
+            result = process_delivery(payload,
+                                      profiling_enabled(config, request.headers),
+                                      recording_enabled(config, request.headers),
+                                      tokens)
+    except Saturated as e:
+        print('shedding delivery for PR %s: %s' % (payload['pull_request']['number'], e))
+        # 503 when we can't take anything, 429 when only less valuable events
+        # are being turned away.
+        return ('', 503 if e.full else 429,
+                {'Retry-After': str(config.get('retry_after', RETRY_AFTER))})
+    if not result:
+        if breaker_open(config):
+            # GitHub is failing; try this delivery again once it recovers.
+            spool_delivery(config, payload)
+            return ('', 202)
+        return ('', 500)
+    return ('', 204)
+
+@app.route("/upstream-hook", methods=["POST"])
+def upstream_webhook():
+    # Status and check events from the upstream repository may mean that a
+    # queued merge can now go ahead.
+    payload = json.loads(request.form.get('payload', '{}'))
+    event = request.headers.get('X-GitHub-Event')
+    if event == 'status':
+        poke_merge_queue(config, payload['sha'])
+    elif event in ['check_suite', 'check_run']:
+        poke_merge_queue(config, payload[event]['head_sha'])
+    return ('', 204)
 
 @app.route("/test", methods=["POST"])
 def test():
@@ -82,6 +179,17 @@ def test():
 def ping():
     return ('pong', 200)
 
+@app.route("/health/live")
+def liveness():
+    return ('ok', 200)
+
+@app.route("/health/ready")
+def readiness():
+    stats = admission.stats()
+    stats['bootstrapped'] = bootstrapped()
+    stats['ready'] = stats['bootstrapped'] and admission.ready()
+    return (jsonify(stats), 200 if stats['ready'] else 503)
+
 @app.route("/shutdown", methods=["POST"])
 def shutdown():
     func = request.environ.get('werkzeug.server.shutdown')
@@ -90,19 +198,33 @@ def shutdown():
     func()
     return ('', 204)
 
-def main(_config, _pr_db):
-    global config, pr_db
+def init(_config, _pr_db):
+    global config, pr_db, admission
     config = _config
     pr_db = _pr_db
+    admission = AdmissionController(config)
+    if config.get('merge_queue', False):
+        start_merge_scheduler(config)
+    if breaker_enabled(config):
+        start_spool_drainer(config, process_delivery)
+
+def main(_config, _pr_db):
+    init(_config, _pr_db)
     app.run(port=config['port'])
 
+def start_background(config):
+    """Initialise the server while the clones are created in the background.
+    Deliveries that arrive in the meantime are spooled and replayed after."""
+    init(config, read_pr_db(config))
+    on_ready = None
+    if not breaker_enabled(config):
+        on_ready = partial(start_spool_drainer, config, process_delivery)
+    start_bootstrap(config, on_ready)
+
 def start():
     config = read_config()
-    if not os.path.isdir(config['wpt_path']):
-        git(["clone", "https://github.com/w3c/web-platform-tests.git", config["wpt_path"]], cwd='.')
-    if not os.path.isdir(config['servo_path']):
-        git(["clone", "https://github.com/servo/servo.git", config["servo_path"]], cwd='.')
-    main(config, read_pr_db())
+    start_background(config)
+    app.run(port=config['port'])
 
 if __name__ == "__main__":
     start()
@@ -0,0 +1,153 @@
+# Upstream PRs whose merge failed when the Servo PR merged (usually because
+# upstream CI had not finished) are queued in the shared state directory and
+# retried from a single scheduler thread. Each check uses conditional requests,
+# so an unchanged PR costs nothing against the API rate limit.
+
+from functools import partial
+import threading
+import time
+from api import authenticated
+from state import file_lock, read_merge_queue, state_path, update_merge_queue, LOCK_DIR
+from sync import (upstream_pulls, _do_merge_upstream_pr, remove_upstream_pr_label,
+                  modify_upstream_pr_labels, _do_comment_on_upstream_pr, UPSTREAM_ERROR_BODY)
+
+MERGE_QUEUE_INTERVAL = 60
+MERGE_QUEUE_ATTEMPTS = 5
+MERGE_QUEUE_TIMEOUT = 6 * 60 * 60
+
+# Mergeable states in which GitHub will accept a merge, and ones that will
+# never resolve without human intervention.
+MERGEABLE_STATES = ['clean', 'unstable', 'has_hooks']
+FAILED_STATES = ['dirty']
+FAILED_STATUSES = ['failure', 'error']
+
+_wakeup = threading.Event()
+
+
+def _conditional_get(config, url, etag):
+    headers = {'If-None-Match': etag} if etag else None
+    r = authenticated(config, 'GET', url, headers=headers)
+    if r.status_code == 304:
+        return None, etag
+    return r.json(), r.headers.get('ETag')
+
+
+def _refresh(config, upstream, entry):
+    pr, entry['pr_etag'] = _conditional_get(config,
+                                            upstream_pulls(config) + '/' + upstream,
+                                            entry.get('pr_etag'))
+    if pr is not None:
+        if pr['merged'] or pr['state'] == 'closed':
+            entry['done'] = True
+            return
+        entry['sha'] = pr['head']['sha']
+        entry['mergeable_state'] = pr.get('mergeable_state')
+
+    if entry.get('mergeable_state') in MERGEABLE_STATES + FAILED_STATES or not entry.get('sha'):
+        return
+    status, entry['status_etag'] = _conditional_get(
+        config,
+        'repos/%s/web-platform-tests/commits/%s/status' % (config['upstream_org'], entry['sha']),
+        entry.get('status_etag'))
+    if status is not None:
+        entry['status'] = status['state']
+
+
+def _give_up(config, upstream):
+    modify_upstream_pr_labels(config, 'POST', ['stale-sevo-export'], upstream)
+    _do_comment_on_upstream_pr(config, upstream, UPSTREAM_ERROR_BODY)
+
+
+def _check_queued_merge(config, upstream, entry, now):
+    """Returns the updated queue entry, or None once the PR needs no more checks."""
+    _refresh(config, upstream, entry)
+    if entry.get('done'):
+        return None
+
+    failed = (entry.get('mergeable_state') in FAILED_STATES or
+              entry.get('status') in FAILED_STATUSES)
+    if not failed and entry.get('mergeable_state') in MERGEABLE_STATES:
+        entry['attempts'] += 1
+        try:
+            try:
+                remove_upstream_pr_label(config, 'do not merge yet', upstream)
+            except ValueError:
+                # Already removed by an earlier attempt.
+                pass
+            _do_merge_upstream_pr(config, upstream)
+            print('merged queued upstream PR %s' % upstream)
+            return None
+        except ValueError as e:
+            print('failed to merge queued upstream PR %s: %s' % (upstream, e))
+            failed = entry['attempts'] >= config.get('merge_queue_attempts', MERGE_QUEUE_ATTEMPTS)
+
+    if failed or now - entry['queued_at'] > config.get('merge_queue_timeout', MERGE_QUEUE_TIMEOUT):
+        print('giving up on merging upstream PR %s' % upstream)
+        _give_up(config, upstream)
+        return None
+
+    entry['next_check'] = now + config.get('merge_queue_interval', MERGE_QUEUE_INTERVAL)
+    return entry
+
+
+def process_merge_queue(config, now=None):
+    """Check every queued merge that is due. Only one worker across all nodes
+    does this at a time; the others skip the tick."""
+    now = now or time.time()
+    with file_lock(state_path(config, LOCK_DIR, 'merge_queue_scheduler.lock'),
+                   blocking=False) as acquired:
+        if not acquired:
+            return
+        for (upstream, entry) in read_merge_queue(config).items():
+            if entry['next_check'] > now:
+                continue
+            pokes = entry.get('pokes', 0)
+            try:
+                entry = _check_queued_merge(config, upstream, dict(entry), now)
+            except Exception as e:
+                print('error checking queued upstream PR %s: %s' % (upstream, e))
+                entry['next_check'] = now + config.get('merge_queue_interval', MERGE_QUEUE_INTERVAL)
+            update_merge_queue(config, upstream, partial(_merge_checked_entry, entry, pokes))
+
+
+def _merge_checked_entry(checked, pokes, current):
+    # The queue isn't locked while a merge is checked, so the entry may have
+    # been poked in the meantime; that poke must not be lost.
+    if checked is None or current is None:
+        return checked
+    entry = dict(current, **checked)
+    entry['pokes'] = current.get('pokes', 0)
+    if entry['pokes'] != pokes:
+        entry['next_check'] = current['next_check']
+    return entry
+
+
+def poke_merge_queue(config, sha=None):
+    """Make queued merges (only those for the given head commit, if any) due
+    for an immediate check, eg. because an upstream status or check changed."""
+    for (upstream, entry) in read_merge_queue(config).items():
+        if sha and entry.get('sha') not in [None, sha]:
+            continue
+
+        def make_due(entry):
+            if entry is not None:
+                entry['next_check'] = 0
+                entry['pokes'] = entry.get('pokes', 0) + 1
+            return entry
+        update_merge_queue(config, upstream, make_due)
+    _wakeup.set()
+
+
+def start_merge_scheduler(config):
+    def run():
+        while True:
+            _wakeup.wait(config.get('merge_queue_interval', MERGE_QUEUE_INTERVAL))
+            _wakeup.clear()
+            try:
+                process_merge_queue(config)
+            except Exception as e:
+                print('error processing merge queue: %s' % e)
+    thread = threading.Thread(target=run)
+    thread.daemon = True
+    thread.start()
+    return thread
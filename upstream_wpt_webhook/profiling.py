@@ -0,0 +1,97 @@
+from contextlib import contextmanager
+import cProfile
+import json
+import os
+import pstats
+import threading
+import time
+try:
+    from StringIO import StringIO
+except ImportError:
+    from io import StringIO
+
+PROFILE_HEADER = 'X-Wpt-Sync-Profile'
+
+_current = threading.local()
+# Only one profiler may be active per process (enforced from Python 3.12), so
+# concurrent deliveries that ask to be profiled run unprofiled instead.
+_profiler_lock = threading.Lock()
+
+
+class Timeline:
+    def __init__(self):
+        self.start = time.time()
+        self.events = []
+
+
+@contextmanager
+def timed(kind, detail):
+    """Record a timeline event for the profiled run on this thread, if any.
+    The yielded event may be updated by the caller before the block exits."""
+    timeline = getattr(_current, 'timeline', None)
+    if timeline is None:
+        yield {}
+        return
+    event = {
+        'kind': kind,
+        'detail': detail,
+        'start': time.time() - timeline.start,
+    }
+    try:
+        yield event
+    finally:
+        event['duration'] = time.time() - timeline.start - event['start']
+        timeline.events.append(event)
+
+
+def profiling_enabled(config, headers):
+    return config.get('profile', False) or headers.get(PROFILE_HEADER, '') not in ['', '0']
+
+
+def run_profiled(config, payload, func):
+    """Run func under the profiler, saving the results next to any error
+    snapshots if it took longer than config['profile_threshold'] seconds.
+    Runs func unprofiled if another run is already being profiled."""
+    if not _profiler_lock.acquire(False):
+        print('another sync is being profiled; running unprofiled')
+        return func()
+    try:
+        profiler = cProfile.Profile()
+        try:
+            profiler.enable()
+        except ValueError as e:
+            # Another profiling tool, such as a debugger, is active.
+            print('not profiling: %s' % e)
+            return func()
+        timeline = Timeline()
+        _current.timeline = timeline
+        try:
+            return func()
+        finally:
+            profiler.disable()
+            _current.timeline = None
+            _save_if_slow(config, payload, profiler, timeline)
+    finally:
+        _profiler_lock.release()
+
+
+def _save_if_slow(config, payload, profiler, timeline):
+    elapsed = time.time() - timeline.start
+    if elapsed >= config.get('profile_threshold', 0):
+        dir_name = save_profile(payload, profiler, timeline, elapsed)
+        print('saved profile: %s (%.2fs)' % (dir_name, elapsed))
+
+
+def save_profile(payload, profiler, timeline, elapsed):
+    name = 'profile-snapshot-%s' % int(round(time.time() * 1000))
+    os.mkdir(name)
+    with open(os.path.join(name, 'payload.json'), 'w') as f:
+        f.write(json.dumps(payload, indent=2))
+    with open(os.path.join(name, 'timeline.json'), 'w') as f:
+        f.write(json.dumps({'elapsed': elapsed, 'events': timeline.events}, indent=2))
+    profiler.dump_stats(os.path.join(name, 'profile.pstats'))
+    out = StringIO()
+    pstats.Stats(profiler, stream=out).sort_stats('cumulative').print_stats(50)
+    with open(os.path.join(name, 'profile.txt'), 'w') as f:
+        f.write(out.getvalue())
+    return name
@@ -0,0 +1,229 @@
+# Record mode captures everything a sync exchanges with the outside world: API
+# responses, the PR diff, the output of every git command and the filtered diff
+# of every commit. A capture can then be replayed offline by replay.py, with no
+# network access and no Servo clone, to measure the cost of each step on real
+# traffic.
+
+import copy
+import json
+import os
+import re
+import shutil
+import subprocess
+import threading
+import time
+from spooled import CHUNK_SIZE, spooled_file
+
+RECORD_HEADER = 'X-Wpt-Sync-Record'
+# Git commands that talk to a remote; they are never executed when replaying.
+REMOTE_COMMANDS = ['fetch', 'push', 'clone', 'ls-remote']
+# Configuration that affects which requests and commands a sync makes.
+RECORDED_CONFIG = ['servo_org', 'username', 'upstream_org', 'suppress_force_push',
+                   'commit_source', 'graphql', 'merge_queue']
+
+_current = threading.local()
+
+
+def current_recorder():
+    return getattr(_current, 'recorder', None)
+
+
+def current_player():
+    return getattr(_current, 'player', None)
+
+
+def recording_enabled(config, headers):
+    return config.get('record', False) or headers.get(RECORD_HEADER, '') not in ['', '0']
+
+
+def _redact(args):
+    # Remote URLs embed the token.
+    return [re.sub(r'//[^/@]*@', '//', arg) for arg in args]
+
+
+def _repo_role(config, cwd):
+    for role in ['servo', 'wpt']:
+        path = config.get(role + '_path')
+        if path and os.path.abspath(path) == os.path.abspath(cwd):
+            return role
+    return None
+
+
+class Recorder:
+    def __init__(self, config):
+        self.config = config
+        self.http = []
+        self.git = []
+        self.node_ids = {}
+        self.fetched_node_ids = set()
+        self.pr_diff = None
+        self.dir_name = 'capture-%s' % int(round(time.time() * 1000))
+        os.mkdir(self.dir_name)
+        os.mkdir(os.path.join(self.dir_name, 'diffs'))
+
+    def provider(self, provider):
+        def recording_provider(pull_request):
+            if self.pr_diff is None:
+                self.pr_diff = provider(pull_request)
+            return self.pr_diff
+        return recording_provider
+
+    def record_http(self, method, url, data, response):
+        self.http += [{
+            'method': method,
+            'url': url,
+            'json': data,
+            'status': response.status_code,
+            'etag': response.headers.get('ETag'),
+            'body': response.text,
+        }]
+
+    def record_git(self, cwd, command_line, returncode, output):
+        entry = {
+            'role': _repo_role(self.config, cwd),
+            'args': _redact(command_line[1:]),
+            'returncode': returncode,
+            'output': output.decode('utf-8', 'replace'),
+        }
+        if entry['role'] == 'wpt' and entry['args'][0] == 'fetch' and not returncode:
+            # Lets a replay against a real WPT clone reproduce the fetch locally.
+            entry['fetch_head'] = subprocess.check_output(['git', 'rev-parse', 'FETCH_HEAD'],
+                                                          cwd=cwd).decode('utf-8').strip()
+        self.git += [entry]
+
+    def record_node_ids(self, cached, fetched):
+        # Ids fetched during this sync will be fetched again when replaying.
+        self.fetched_node_ids.update(fetched)
+        for (key, node_id) in cached.items():
+            if key not in self.fetched_node_ids:
+                self.node_ids[key] = node_id
+
+    def record_diff(self, commit, diff):
+        with open(os.path.join(self.dir_name, 'diffs', commit + '.diff'), 'wb') as f:
+            shutil.copyfileobj(diff, f, CHUNK_SIZE)
+        diff.seek(0)
+
+    def record(self, payload, pr_db, branch, func):
+        orig_pr_db = copy.deepcopy(pr_db)
+        _current.recorder = self
+        try:
+            return func()
+        finally:
+            _current.recorder = None
+            self.save(payload, orig_pr_db, branch)
+
+    def save(self, payload, pr_db, branch):
+        config = dict((key, self.config[key]) for key in RECORDED_CONFIG if key in self.config)
+        for (name, data) in [('payload.json', payload),
+                             ('pr_db.json', pr_db),
+                             ('config.json', config),
+                             ('branch.json', branch),
+                             ('http.json', self.http),
+                             ('git.json', self.git),
+                             ('node_ids.json', [list(key) + [node_id] for (key, node_id)
+                                                in self.node_ids.items()])]:
+            with open(os.path.join(self.dir_name, name), 'w') as f:
+                f.write(json.dumps(data, indent=2))
+        with open(os.path.join(self.dir_name, 'pr.diff'), 'w') as f:
+            f.write(self.pr_diff or '')
+        print('saved capture: %s' % self.dir_name)
+
+
+def record_git(cwd, command_line, returncode, output):
+    recorder = current_recorder()
+    if recorder:
+        recorder.record_git(cwd, command_line, returncode, output)
+
+
+def record_http(method, url, data, response):
+    recorder = current_recorder()
+    if recorder:
+        recorder.record_http(method, url, data, response)
+
+
+def record_diff(commit, diff):
+    recorder = current_recorder()
+    if recorder:
+        recorder.record_diff(commit, diff)
+
+
+def record_node_ids(cached={}, fetched=[]):
+    """Record GraphQL node ids that were served from the process's cache, as
+    a replay won't have them cached, and those that were fetched."""
+    recorder = current_recorder()
+    if recorder:
+        recorder.record_node_ids(cached, fetched)
+
+
+class ReplayedResponse:
+    def __init__(self, entry):
+        self.status_code = entry['status']
+        self.text = entry['body']
+        self.headers = {'ETag': entry['etag']} if entry.get('etag') else {}
+
+    def json(self):
+        return json.loads(self.text)
+
+
+class Player:
+    """Serves the requests and commands of a replayed sync from a capture.
+    If execute_wpt is set, git commands in the WPT clone that don't talk to a
+    remote are run for real."""
+    def __init__(self, capture_dir, config, execute_wpt=False):
+        self.capture_dir = capture_dir
+        self.config = config
+        self.execute_wpt = execute_wpt
+        self.http_responses = {}
+        self.git_outputs = {}
+        with open(os.path.join(capture_dir, 'http.json')) as f:
+            for entry in json.loads(f.read()):
+                self.http_responses.setdefault((entry['method'], entry['url']), []).append(entry)
+        with open(os.path.join(capture_dir, 'git.json')) as f:
+            for entry in json.loads(f.read()):
+                self.git_outputs.setdefault((entry['role'], tuple(entry['args'])), []).append(entry)
+        self.node_ids = {}
+        try:
+            with open(os.path.join(capture_dir, 'node_ids.json')) as f:
+                for entry in json.loads(f.read()):
+                    self.node_ids[tuple(entry[:-1])] = entry[-1]
+        except IOError:
+            # Captured before node ids were recorded.
+            pass
+
+    def http(self, method, url, data):
+        responses = self.http_responses.get((method, url))
+        if not responses:
+            raise ValueError('no recorded response for %s %s' % (method, url))
+        return ReplayedResponse(responses.pop(0))
+
+    def git(self, cwd, command_line):
+        """Returns the recorded output, or None if the command should be run."""
+        role = _repo_role(self.config, cwd)
+        args = _redact(command_line[1:])
+        if role == 'wpt' and self.execute_wpt and args[0] not in REMOTE_COMMANDS:
+            return None
+        outputs = self.git_outputs.get((role, tuple(args)))
+        if not outputs:
+            raise ValueError('no recorded output for git %s' % ' '.join(args))
+        entry = outputs.pop(0)
+        if role == 'wpt' and self.execute_wpt and 'fetch_head' in entry:
+            subprocess.check_call(['git', 'update-ref', 'refs/remotes/origin/' + args[-1],
+                                   entry['fetch_head']], cwd=cwd)
+        if entry['returncode']:
+            raise subprocess.CalledProcessError(entry['returncode'], command_line,
+                                                output=entry['output'].encode('utf-8'))
+        return entry['output']
+
+    def diff(self, commit, max_size=0):
+        out = spooled_file(max_size)
+        with open(os.path.join(self.capture_dir, 'diffs', commit + '.diff'), 'rb') as f:
+            shutil.copyfileobj(f, out, CHUNK_SIZE)
+        out.seek(0)
+        return out
+
+    def replay(self, func):
+        _current.player = self
+        try:
+            return func()
+        finally:
+            _current.player = None
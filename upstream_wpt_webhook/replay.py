@@ -1,22 +1,12 @@
 from sync import process_and_run_steps
+from recording import Player
+import argparse
 import json
+import multiprocessing
 import os
 import sys
-
-if len(sys.argv) != 2:
-    print("usage: python replay.py [snapshot_dir]")
-    sys.exit(1)
-
-snapshot_dir = sys.argv[1]
-
-with open(os.path.join(snapshot_dir, "payload.json")) as f:
-    payload = json.loads(f.read())
-
-with open(os.path.join(snapshot_dir, "pr_db.json")) as f:
-    db = json.loads(f.read())
-
-with open(os.path.join(snapshot_dir, "pr.diff")) as f:
-    pr_diff = f.read()
+import tempfile
+import time
 
 config = {
     'servo_org': 'servo',
@@ -27,15 +17,112 @@ config = {
     'api': 'http://api.github.com',
 }
 
-def get_pr_diff(pull_request):
-    return pr_diff
+def read_json(dir_name, name):
+    with open(os.path.join(dir_name, name)) as f:
+        return json.loads(f.read())
+
+def read_pr_diff(dir_name):
+    with open(os.path.join(dir_name, "pr.diff")) as f:
+        return f.read()
+
+def replay_snapshot(snapshot_dir):
+    # Re-run a saved error snapshot against the live API.
+    payload = read_json(snapshot_dir, "payload.json")
+    db = read_json(snapshot_dir, "pr_db.json")
+    pr_diff = read_pr_diff(snapshot_dir)
+
+    def get_pr_diff(pull_request):
+        return pr_diff
+
+    error = []
+    def error_callback(dir_name):
+        error.append(dir_name)
+        print('saved error snapshot: %s' % dir_name)
+
+    process_and_run_steps(config, db, payload, get_pr_diff, True, error_callback=error_callback)
+    return not error
+
+def replay_capture(capture_dir, wpt_path=None):
+    """Replay a capture saved in record mode without any network access.
+    Returns the outcome and how long each step took."""
+    payload = read_json(capture_dir, "payload.json")
+    db = read_json(capture_dir, "pr_db.json")
+    pr_diff = read_pr_diff(capture_dir)
+    replay_config = dict(config)
+    replay_config.update(read_json(capture_dir, "config.json"))
+    replay_config.update({
+        'servo_path': tempfile.mkdtemp(),
+        'wpt_path': wpt_path or tempfile.mkdtemp(),
+        'state_path': tempfile.mkdtemp(),
+    })
+    player = Player(capture_dir, replay_config, execute_wpt=wpt_path is not None)
+
+    steps = []
+    times = [time.time()]
+    def step_callback(step):
+        now = time.time()
+        steps.append((step.name, now - times[-1]))
+        times.append(now)
+
+    error = []
+    def error_callback(dir_name):
+        error.append(dir_name)
+
+    result = player.replay(lambda: process_and_run_steps(replay_config, db, payload,
+                                                         lambda pull_request: pr_diff,
+                                                         read_json(capture_dir, "branch.json"),
+                                                         step_callback=step_callback,
+                                                         error_callback=error_callback))
+    return {
+        'capture': capture_dir,
+        'result': result,
+        'error_snapshot': error[0] if error else None,
+        'total': time.time() - times[0],
+        'steps': steps,
+    }
+
+def _replay_capture(args):
+    return replay_capture(*args)
+
+def replay_captures(captures_dir, jobs, wpt_path=None):
+    captures = sorted(os.path.join(captures_dir, name) for name in os.listdir(captures_dir)
+                      if os.path.isfile(os.path.join(captures_dir, name, 'http.json')))
+    if wpt_path:
+        # Replays that run git share the WPT clone, so can't run concurrently.
+        jobs = 1
+    pool = multiprocessing.Pool(jobs)
+    try:
+        return pool.map(_replay_capture, [(capture, wpt_path) for capture in captures])
+    finally:
+        pool.close()
+
+def print_report(reports):
+    for report in reports:
+        print('%s: %s in %.3fs' % (report['capture'],
+                                   'ok' if report['result'] else 'failed (%s)' % report['error_snapshot'],
+                                   report['total']))
+        for (name, seconds) in report['steps']:
+            print('  %-60s %.3fs' % (name, seconds))
+
+def main():
+    parser = argparse.ArgumentParser(description='Replay a saved error snapshot against the live API, '
+                                     'or replay captures saved in record mode offline.')
+    parser.add_argument('dir', help='error snapshot, capture, or directory of captures')
+    parser.add_argument('--offline', action='store_true', help='replay a single capture offline')
+    parser.add_argument('--batch', action='store_true', help='replay every capture in the directory offline')
+    parser.add_argument('--jobs', type=int, default=multiprocessing.cpu_count(),
+                        help='number of captures to replay in parallel')
+    parser.add_argument('--wpt-path', help='run WPT git commands (except fetch and push) in this clone')
+    args = parser.parse_args()
 
-error = False
-def error_callback(dir_name):
-    global error
-    error = True
-    print('saved error snapshot: %s' % dir_name)
+    if args.batch:
+        reports = replay_captures(args.dir, args.jobs, args.wpt_path)
+    elif args.offline:
+        reports = [replay_capture(args.dir, args.wpt_path)]
+    else:
+        return 0 if replay_snapshot(args.dir) else 1
+    print_report(reports)
+    return 0 if all(report['result'] for report in reports) else 1
 
-process_and_run_steps(config, db, payload, get_pr_diff, True, error_callback=error_callback)
-if error:
-    sys.exit(1)
+if __name__ == "__main__":
+    sys.exit(main())
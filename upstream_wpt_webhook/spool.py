@@ -0,0 +1,109 @@
+# Deliveries that arrive while the circuit breaker is open (or while older
+# spooled deliveries are still waiting, so that events for a PR are never
+# reordered) are written to config['state_path']/spool and replayed in arrival
+# order, one every config['spool_drain_interval'] seconds, once GitHub is
+# healthy again.
+
+import json
+import os
+import threading
+import time
+from api import authenticated
+from bootstrap import bootstrapped
+from circuit_breaker import (breaker_cooled_down, breaker_open, close_breaker, half_open_breaker,
+                             record_failure)
+from state import LOCK_DIR, file_lock, state_path, ensure_dir
+
+SPOOL_DIR = 'spool'
+SPOOL_DRAIN_INTERVAL = 10
+
+_counter = [0]
+
+
+def _spool_dir(config):
+    return state_path(config, SPOOL_DIR)
+
+
+def spooled_deliveries(config):
+    try:
+        return sorted(name for name in os.listdir(_spool_dir(config)) if name.endswith('.json'))
+    except OSError:
+        return []
+
+
+def spool_delivery(config, payload):
+    ensure_dir(_spool_dir(config))
+    _counter[0] += 1
+    name = '%015d-%d-%d.json' % (int(time.time() * 1000), os.getpid(), _counter[0])
+    path = os.path.join(_spool_dir(config), name)
+    with open(path + '.tmp', 'w') as f:
+        f.write(json.dumps(payload))
+    os.rename(path + '.tmp', path)
+    print('spooled delivery for PR %s as %s' % (payload['pull_request']['number'], name))
+    return name
+
+
+def should_spool(config):
+    return breaker_open(config) or bool(spooled_deliveries(config))
+
+
+def healthy(config):
+    try:
+        authenticated(config, 'GET', 'rate_limit')
+        return True
+    except Exception as e:
+        print('health check failed: %s' % e)
+        return False
+
+
+def drain_spool(config, handler):
+    """Replay the oldest spooled delivery with handler(payload), which returns
+    whether it was processed. Returns whether a delivery was replayed."""
+    if not bootstrapped():
+        # The clones that replayed deliveries need don't exist yet.
+        return False
+    with file_lock(state_path(config, LOCK_DIR, 'spool_drain.lock'), blocking=False) as acquired:
+        if not acquired:
+            return False
+        names = spooled_deliveries(config)
+        if breaker_open(config):
+            if not breaker_cooled_down(config):
+                return False
+            if not healthy(config):
+                # Keep the breaker open for another cooldown period.
+                record_failure(config)
+                return False
+            if not names:
+                # There is no delivery to try, so the health check has to do.
+                close_breaker(config)
+                return False
+            # The oldest delivery decides whether GitHub has really recovered.
+            half_open_breaker(config)
+        if not names:
+            return False
+
+        path = os.path.join(_spool_dir(config), names[0])
+        with open(path) as f:
+            payload = json.loads(f.read())
+        result = handler(payload)
+        if not result and breaker_open(config):
+            # GitHub failed again, which re-opened the breaker; keep the
+            # delivery at the head of the spool.
+            return False
+        os.remove(path)
+        close_breaker(config)
+        return True
+
+
+def start_spool_drainer(config, handler):
+    def run():
+        while True:
+            time.sleep(config.get('spool_drain_interval', SPOOL_DRAIN_INTERVAL))
+            try:
+                drain_spool(config, handler)
+            except Exception as e:
+                print('error draining spool: %s' % e)
+    thread = threading.Thread(target=run)
+    thread.daemon = True
+    thread.start()
+    return thread
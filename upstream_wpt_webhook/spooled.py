@@ -0,0 +1,15 @@
+# Diffs are passed around as temporary files that are kept in memory only while
+# they are smaller than a per-event budget (see DIFF_MEMORY_LIMIT in sync.py).
+
+import tempfile
+
+CHUNK_SIZE = 64 * 1024
+
+
+def spooled_file(max_size=0):
+    """A temporary file that rolls over to disk once it holds more than
+    max_size bytes. With max_size=0 it is on disk from the start, since a
+    SpooledTemporaryFile with max_size=0 would never roll over."""
+    if max_size:
+        return tempfile.SpooledTemporaryFile(max_size=max_size)
+    return tempfile.TemporaryFile()
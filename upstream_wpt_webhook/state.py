@@ -0,0 +1,146 @@
+from contextlib import contextmanager
+import errno
+import fcntl
+import json
+import os
+import time
+
+# State that must be shared between every worker process (and every node) that
+# serves the webhook lives under config['state_path']. Point it at a shared
+# filesystem when running on more than one host.
+PR_DB_FILE = 'pr_map.json'
+MERGE_QUEUE_FILE = 'merge_queue.json'
+LOCK_DIR = 'locks'
+
+
+def state_path(config, *parts):
+    return os.path.join(config.get('state_path', '.'), *parts)
+
+
+def ensure_dir(path):
+    try:
+        os.makedirs(path)
+    except OSError as e:
+        if e.errno != errno.EEXIST:
+            raise
+
+
+@contextmanager
+def file_lock(path, shared=False, blocking=True):
+    """Hold an flock on path. With blocking=False, yields whether the lock
+    was acquired instead of waiting for it."""
+    ensure_dir(os.path.dirname(os.path.abspath(path)))
+    with open(path, 'a') as f:
+        flags = fcntl.LOCK_SH if shared else fcntl.LOCK_EX
+        try:
+            fcntl.flock(f.fileno(), flags if blocking else flags | fcntl.LOCK_NB)
+        except (IOError, OSError) as e:
+            if blocking or e.errno not in (errno.EACCES, errno.EAGAIN):
+                raise
+            yield False
+            return
+        try:
+            yield True
+        finally:
+            fcntl.flock(f.fileno(), fcntl.LOCK_UN)
+
+
+def pr_lock(config, pr_number):
+    # Guarantees that at most one worker processes a given Servo PR at a time.
+    return file_lock(state_path(config, LOCK_DIR, 'pr-%s.lock' % pr_number))
+
+
+def repo_lock(path):
+    # Clones are local to a node, so their lock lives next to the clone rather
+    # than in the shared state directory.
+    return file_lock(os.path.abspath(path).rstrip(os.sep) + '.lock')
+
+
+def json_lock(config, name, shared=False):
+    return file_lock(state_path(config, LOCK_DIR, name + '.lock'), shared)
+
+
+def read_json(config, name):
+    try:
+        with open(state_path(config, name)) as f:
+            return json.loads(f.read())
+    except:
+        return {}
+
+
+def write_json(config, name, data):
+    path = state_path(config, name)
+    tmp_path = '%s.%d.tmp' % (path, os.getpid())
+    with open(tmp_path, 'w') as f:
+        f.write(json.dumps(data))
+    os.rename(tmp_path, path)
+
+
+def read_pr_db(config):
+    with json_lock(config, PR_DB_FILE, shared=True):
+        return read_json(config, PR_DB_FILE)
+
+
+def update_pr_db(config, pr_number, upstream):
+    """Record the upstream PR for a single Servo PR (or forget it if upstream
+    is None) without clobbering entries written concurrently by other workers."""
+    with json_lock(config, PR_DB_FILE):
+        pr_db = read_json(config, PR_DB_FILE)
+        if upstream is None:
+            pr_db.pop(pr_number, None)
+        else:
+            pr_db[pr_number] = upstream
+        write_json(config, PR_DB_FILE, pr_db)
+        return pr_db
+
+
+def read_merge_queue(config):
+    with json_lock(config, MERGE_QUEUE_FILE, shared=True):
+        return read_json(config, MERGE_QUEUE_FILE)
+
+
+def update_merge_queue(config, upstream, update):
+    """Replace the queue entry for an upstream PR with update(entry), where
+    entry is None if it is not queued; returning None removes it."""
+    upstream = str(upstream)
+    with json_lock(config, MERGE_QUEUE_FILE):
+        queue = read_json(config, MERGE_QUEUE_FILE)
+        entry = update(queue.get(upstream))
+        if entry is None:
+            queue.pop(upstream, None)
+        else:
+            queue[upstream] = entry
+        write_json(config, MERGE_QUEUE_FILE, queue)
+        return entry
+
+
+def enqueue_merge(config, upstream):
+    now = time.time()
+    return update_merge_queue(config, upstream, lambda entry: entry or {
+        'queued_at': now,
+        'next_check': now,
+        'attempts': 0,
+    })
+
+
+def _generation_path(config, pr_number):
+    return state_path(config, 'generations', 'pr-%s' % pr_number)
+
+
+def pr_generation(config, pr_number):
+    try:
+        with open(_generation_path(config, pr_number)) as f:
+            return int(f.read())
+    except (IOError, OSError, ValueError):
+        return 0
+
+
+def supersede_pr(config, pr_number):
+    """Record that a newer event has arrived for this PR, so that any older
+    in-flight sync for it should stop at its next safe point."""
+    path = _generation_path(config, pr_number)
+    with file_lock(path + '.lock'):
+        generation = pr_generation(config, pr_number) + 1
+        with open(path, 'w') as f:
+            f.write(str(generation))
+        return generation
@@ -2,18 +2,29 @@ import copy
 from functools import partial
 import json
 import os
-import requests
+import shutil
 import sys
 import subprocess
 import time
 import traceback
-try:
-    import urlparse
-except ImportError:
-    from urllib import parse as urlparse
+from api import authenticated
+from cancellation import (Cancelled, CancellationToken, TimedOut, cancellable, check_cancelled,
+                          kill_on_cancel, uncancellable, NEW_PROCESS_GROUP)
+from circuit_breaker import remote_operation
+from diff_cache import cache_enabled, read_cached_diff, write_cached_diff
+from profiling import timed
+from recording import current_player, record_diff, record_git
+from spooled import CHUNK_SIZE, spooled_file
+from state import enqueue_merge, repo_lock
+import github_graphql
 
 UPSTREAMABLE_PATH = 'tests/wpt/web-platform-tests/'
 NO_SYNC_SIGNAL = '[no-wpt-sync]'
+# Default upper bound on the bytes of commit diffs kept in memory per event;
+# anything beyond this is spooled to temporary files.
+DIFF_MEMORY_LIMIT = 16 * 1024 * 1024
+# Default overall time budget in seconds for processing a single event.
+EVENT_TIMEOUT = 30 * 60
 
 def upstream_pulls(config):
     return "repos/%s/web-platform-tests/pulls" % config['upstream_org']
@@ -40,45 +51,98 @@ class AsyncValue:
         return self._value
 
 
-def authenticated(config, method, url, json=None):
-    s = requests.Session()
-    if not method:
-        method = 'GET'
-    s.headers = {
-        'Authorization': 'token %s' % config['token'],
-        'User-Agent': 'Servo web-platform-test sync service',
-    }
-    if 'override_host' in config:
-        # Ensure that any URLs retrieved are rewritten to use the overriden host
-        partial = urlparse.urlsplit(url)
-        url = partial[2] + partial[3] + partial[4]
-
-    url = urlparse.urljoin(config['api'], url)
-    print('fetching %s' % url)
-    response = s.request(method, url, json=json)
-    if int(response.status_code / 100) != 2:
-        raise ValueError('got unexpected %d response: %s' % (response.status_code, response.text))
-    return response
-
-
 def git(*args, **kwargs):
     command_line = ["git"] + list(*args)
     #print(' '.join(map(lambda x: ('"%s"' % x) if ' ' in x else x, command_line)))
+    check_cancelled()
     try:
-        out = subprocess.check_output(command_line, cwd=kwargs['cwd'], env=kwargs.get('env', {}))
+        player = current_player()
+        if player:
+            out = player.git(kwargs['cwd'], command_line)
+            if out is not None:
+                return out
+        with timed('git', ' '.join(command_line[:3])):
+            process = subprocess.Popen(command_line, cwd=kwargs['cwd'], env=kwargs.get('env', {}),
+                                       stdout=subprocess.PIPE, **NEW_PROCESS_GROUP)
+            with kill_on_cancel(process):
+                out = process.communicate()[0]
+        record_git(kwargs['cwd'], command_line, process.returncode, out)
+        if process.returncode:
+            raise subprocess.CalledProcessError(process.returncode, command_line, output=out)
         return out.decode('utf-8')
     except subprocess.CalledProcessError as e:
         print(e.output)
         raise e
 
 
+def git_spooled(*args, **kwargs):
+    """Like git, but streams the output into a temporary file that is only
+    kept in memory while it is smaller than max_size bytes."""
+    command_line = ["git"] + list(*args)
+    check_cancelled()
+    max_size = kwargs.get('max_size', 0)
+    out = spooled_file(max_size)
+    try:
+        with timed('git', ' '.join(command_line[:3])):
+            process = subprocess.Popen(command_line, cwd=kwargs['cwd'], env=kwargs.get('env', {}),
+                                       stdout=subprocess.PIPE, **NEW_PROCESS_GROUP)
+            with kill_on_cancel(process):
+                for chunk in iter(lambda: process.stdout.read(CHUNK_SIZE), b''):
+                    out.write(chunk)
+                process.stdout.close()
+                retcode = process.wait()
+        if retcode:
+            raise subprocess.CalledProcessError(retcode, command_line)
+    except:
+        out.close()
+        raise
+    out.seek(0)
+    return out
+
+
+def _filtered_diff_args(commit):
+    # Retrieve the diff of any changes to files that are relevant
+    return ["show", "--binary", "--format=%b", commit, '--',  UPSTREAMABLE_PATH]
+
+
 def get_filtered_diff(path, commit, branch=None):
+    return _retry_after_fetch(path, branch,
+                              lambda: git(_filtered_diff_args(commit), cwd=path))
+
+
+def get_filtered_diff_file(path, commit, branch=None, max_size=0):
+    return _retry_after_fetch(path, branch,
+                              lambda: git_spooled(_filtered_diff_args(commit), cwd=path,
+                                                  max_size=max_size))
+
+
+def get_cached_filtered_diff_file(config, commit, branch=None, max_size=0, fetch=None):
+    """fetch, if given, is called before running git for a commit that isn't
+    cached, so that the commits only need to be fetched if one of them isn't."""
+    player = current_player()
+    if player:
+        return player.diff(commit, max_size)
+    if cache_enabled(config):
+        diff = read_cached_diff(config, commit, UPSTREAMABLE_PATH, max_size)
+        if diff is not None:
+            record_diff(commit, diff)
+            return diff
+    if fetch:
+        fetch()
+    diff = get_filtered_diff_file(config['servo_path'], commit, branch, max_size)
+    if cache_enabled(config):
+        write_cached_diff(config, commit, UPSTREAMABLE_PATH, diff)
+    record_diff(commit, diff)
+    return diff
+
+
+def _retry_after_fetch(path, branch, func):
     tries = 1
     while True:
         try:
-            # Retrieve the diff of any changes to files that are relevant
-            return git(["show", "--binary", "--format=%b", commit, '--',  UPSTREAMABLE_PATH],
-                       cwd=path)
+            return func()
+        except Cancelled:
+            raise
         except Exception as e:
             if tries < 6 and branch:
                 # Wait 10 seconds, then try fetching the branch again
@@ -89,9 +153,10 @@ def get_filtered_diff(path, commit, branch=None):
             raise e
 
 
-def fetch_upstream_branch(path, branch):
+def fetch_upstream_branch(path, branch, base=None):
     # Retrieve all of the commits from the upstream pull request
-    return git(["fetch", "origin", branch], cwd=path)
+    with repo_lock(path):
+        return git(["fetch", "origin", branch] + ([base] if base else []), cwd=path)
 
 
 class UpstreamStep(Step):
@@ -107,7 +172,11 @@ class UpstreamStep(Step):
 
     def run(self, config):
         commits = self.commits.value()
-        branch = _upstream(config, self.servo_pr_number, commits, self.pre_commit_callback)
+        try:
+            branch = _upstream(config, self.servo_pr_number, commits, self.pre_commit_callback)
+        finally:
+            for commit in commits:
+                commit['diff'].close()
         self.branch.resolve(branch)
         self.name += ':%d:%s' % (len(commits), branch)
 
@@ -126,7 +195,8 @@ def _upstream(config, servo_pr_number, commits, pre_commit_callback, pre_delete_
 
         # Ensure WPT clone is up to date.
         git(["checkout", "master"], cwd=config['wpt_path'])
-        git(["fetch", "origin", "master"], cwd=config['wpt_path'])
+        with remote_operation(config):
+            git(["fetch", "origin", "master"], cwd=config['wpt_path'])
         git(["reset", "--hard", "origin/master"], cwd=config['wpt_path'])
 
         # Create a new branch with a unique name that is consistent between updates of the same PR
@@ -136,8 +206,9 @@ def _upstream(config, servo_pr_number, commits, pre_commit_callback, pre_delete_
 
         for commit in commits:
             # Export the current diff to a file
-            with open(patch_path, 'w') as f:
-                f.write(commit['diff'])
+            commit['diff'].seek(0)
+            with open(patch_path, 'wb') as f:
+                shutil.copyfileobj(commit['diff'], f, CHUNK_SIZE)
 
             # Apply the filtered changes
             git(["apply", PATCH_FILE, "-p", str(STRIP_COUNT)], cwd=config['wpt_path'])
@@ -163,22 +234,47 @@ def _upstream(config, servo_pr_number, commits, pre_commit_callback, pre_delete_
 
         if not config.get('suppress_force_push', False):
             # Push the branch upstream (forcing to overwrite any existing changes)
-            git(["push", "-f", remote_url, BRANCH_NAME], cwd=config['wpt_path'])
+            with remote_operation(config):
+                git(["push", "-f", remote_url, BRANCH_NAME], cwd=config['wpt_path'])
         return BRANCH_NAME
 
-    try:
-        result = upstream_inner(config, commits)
-        if pre_delete_callback:
-            pre_delete_callback(git)
-        return result
-    except Exception as e:
-        raise e
-    finally:
+    # The WPT clone has a single working tree, so only one worker on this node
+    # may transplant commits into it at a time.
+    with repo_lock(config['wpt_path']):
         try:
-            git(["checkout", "master"], cwd=config['wpt_path'])
-            git(["branch", "-D", BRANCH_NAME], cwd=config['wpt_path'])
-        except:
+            result = upstream_inner(config, commits)
+            if pre_delete_callback:
+                pre_delete_callback(git)
+            return result
+        except Exception as e:
+            raise e
+        finally:
+            # Leave the clone clean even if this sync was cancelled.
+            with uncancellable():
+                _clean_wpt_clone(config['wpt_path'], BRANCH_NAME)
+
+
+def _clean_wpt_clone(path, branch):
+    # A git command killed on cancellation can leave its lock files and, for
+    # git apply, some of the patch's files behind. Nothing else uses the clone
+    # while repo_lock is held, so any lock file left now is stale.
+    for lock in ['index.lock', 'HEAD.lock', os.path.join('refs', 'heads', branch + '.lock')]:
+        try:
+            os.remove(os.path.join(path, '.git', lock))
+        except OSError:
             pass
+    try:
+        git(["reset", "--hard"], cwd=path)
+        git(["clean", "-fdx"], cwd=path)
+        git(["checkout", "master"], cwd=path)
+    except Exception as e:
+        print('failed to clean up %s: %s' % (path, e))
+        return
+    try:
+        git(["branch", "-D", branch], cwd=path)
+    except subprocess.CalledProcessError:
+        # The branch wasn't created.
+        pass
 
 
 class ChangeUpstreamStep(Step):
@@ -212,14 +308,30 @@ class MergeUpstreamStep(Step):
         self.upstream = upstream
 
     def run(self, config):
-        _merge_upstream_pr(config, self.upstream)
+        try:
+            _merge_upstream_pr(config, self.upstream)
+        except ValueError:
+            if not config.get('merge_queue', False):
+                raise
+            # Upstream CI is probably still running; merge_queue.py will keep
+            # checking and merge once it is green.
+            enqueue_merge(config, self.upstream)
+            self.name += ':queued'
 
 
 def merge_upstream_pr(upstream, steps):
     steps += [MergeUpstreamStep(upstream)]
 
 def _merge_upstream_pr(config, upstream):
+    if config.get('graphql', False):
+        try:
+            return github_graphql.merge_pull_request(config, upstream, ['do not merge yet'])
+        except github_graphql.Unavailable:
+            pass
     remove_upstream_pr_label(config, 'do not merge yet', str(upstream))
+    return _do_merge_upstream_pr(config, upstream)
+
+def _do_merge_upstream_pr(config, upstream):
     data = {
         'merge_method': 'rebase',
     }
@@ -282,14 +394,28 @@ def _open_upstream_pr(config, pr_db, pr_number, title, source_org, branch, body)
         'body': body,
         'maintainer_can_modify': False,
     }
-    r = authenticated(config,
-                      'POST',
-                      upstream_pulls(config),
-                      json=data)
-    result = r.json()
-    pr_db[pr_number] = result["number"]
-    pr_url = result["html_url"]
-    modify_upstream_pr_labels(config, 'POST', ['servo-export', 'do not merge yet'], pr_db[pr_number])
+    labels = ['servo-export', 'do not merge yet']
+    result = None
+    if config.get('graphql', False):
+        try:
+            result = github_graphql.create_pull_request(config, title, data['head'], body, labels)
+        except github_graphql.Unavailable:
+            pass
+    if not result:
+        r = authenticated(config,
+                          'POST',
+                          upstream_pulls(config),
+                          json=data)
+        result = (r.json()["number"], r.json()["html_url"])
+    pr_db[pr_number], pr_url = result
+
+    if config.get('graphql', False):
+        try:
+            github_graphql.add_labels(config, pr_db[pr_number], labels)
+            return pr_url
+        except github_graphql.Unavailable:
+            pass
+    modify_upstream_pr_labels(config, 'POST', labels, pr_db[pr_number])
     return pr_url
 
 
@@ -320,6 +446,16 @@ def _do_comment_on_pr(config, pr_number, body):
                          json=data)
 
 
+def _do_comment_on_upstream_pr(config, pr_number, body):
+    data = {
+        'body': body,
+    }
+    return authenticated(config,
+                         'POST',
+                         'repos/%s/web-platform-tests/issues/%s/comments' % (config['upstream_org'], pr_number),
+                         json=data)
+
+
 def _comment_on_pr(config, pr_number, upstream_url, extra):
     body = '%s\n\nCompleted upstream sync of web-platform-test changes at %s.' % (
         upstream_url, extra)
@@ -356,14 +492,83 @@ def fetch_upstreamable_commits(pull_request, branch, steps):
     return step.provides()['commits']
 
 
-def _fetch_upstreamable_commits(config, pull_request, branch):
+def _pr_commits_from_api(config, pull_request):
     r = authenticated(config, 'GET', pull_request["commits_url"])
-    commit_data = r.json()
+    return r.json()
+
+
+# Commits are NUL-separated, as messages may contain blank lines. Parents are
+# listed before their children regardless of commit dates, like the API does.
+COMMIT_LOG_ARGS = ["log", "--reverse", "--topo-order", "-z", "--format=%H%n%an%n%ae%n%B"]
+
+
+def _pr_commits_from_git(config, pull_request, branch):
+    # Unlike the commits API this is not limited to 250 commits, and author and
+    # message for every commit come from a single local git invocation.
+    path = config['servo_path']
+    with remote_operation(config):
+        fetch_upstream_branch(path, branch, pull_request['base']['ref'])
+    revisions = '%s..%s' % (pull_request['base']['sha'], pull_request['head']['sha'])
+    log = _retry_after_fetch(path, branch,
+                             lambda: git(COMMIT_LOG_ARGS + [revisions], cwd=path))
+    return _parse_git_log(log)
+
+
+def _parse_git_log(log):
+    """Parse the output of git with COMMIT_LOG_ARGS."""
+    commit_data = []
+    for entry in log.split('\0'):
+        if not entry.strip():
+            continue
+        fields = entry.lstrip('\n').split('\n', 3)
+        sha, name, email = fields[:3]
+        message = fields[3] if len(fields) > 3 else ''
+        # Mirror the shape of the commits API response.
+        commit_data += [{
+            'sha': sha,
+            'commit': {
+                'author': {
+                    'name': name,
+                    'email': email,
+                },
+                'message': message.rstrip('\n'),
+            },
+        }]
+    return commit_data
+
+
+def _fetch_upstreamable_commits(config, pull_request, branch):
+    fetched = []
+
+    def fetch():
+        # The PR's commits are only needed in the Servo clone if one of their
+        # diffs isn't cached, so they are fetched on the first miss.
+        if not fetched:
+            with remote_operation(config):
+                fetch_upstream_branch(config['servo_path'], branch)
+            fetched.append(True)
+
+    if config.get('commit_source', 'api') == 'git':
+        # Listing the commits with git needs them fetched already.
+        commit_data = _pr_commits_from_git(config, pull_request, branch)
+        fetched.append(True)
+    else:
+        commit_data = _pr_commits_from_api(config, pull_request)
     filtered_commits = []
-    fetch_upstream_branch(config['servo_path'], branch)
+    # Diffs are kept in memory until they collectively exceed this budget;
+    # later ones are spooled to disk instead.
+    memory_budget = config.get('diff_memory_limit', DIFF_MEMORY_LIMIT)
     for commit in commit_data:
-        diff = get_filtered_diff(config['servo_path'], commit['sha'], branch)
-        if diff:
+        diff = get_cached_filtered_diff_file(config, commit['sha'], branch,
+                                             max_size=memory_budget, fetch=fetch)
+        diff.seek(0, os.SEEK_END)
+        size = diff.tell()
+        diff.seek(0)
+        if size <= memory_budget:
+            memory_budget -= size
+        if not size:
+            diff.close()
+        else:
             # Create an object that contains everything necessary to transplant this
             # commit to another repository.
             filtered_commits += [{
@@ -376,6 +581,7 @@ def _fetch_upstreamable_commits(config, pull_request, branch):
 
 
 SERVO_PR_URL = "https://github.com/%s/servo/pull/%s"
+UPSTREAM_ERROR_BODY = "Error merging pull request automatically. Please merge manually after addressing any CI issues."
 
 def process_new_pr_contents(config, pr_db, pull_request, pr_diff, branch, pre_commit_callback, steps):
     pr_number = str(pull_request['number'])
@@ -447,7 +653,6 @@ def process_closed_pr(pr_db, pull_request, steps):
 
 def process_json_payload(config, pr_db, payload, diff_provider, branch, pre_commit_callback):
     pull_request = payload['pull_request']
-    body 
     if NO_SYNC_SIGNAL in pull_request.get('body', ''):
         return []
 
@@ -462,7 +667,7 @@ def process_json_payload(config, pr_db, payload, diff_provider, branch, pre_comm
     return steps
 
 
-def save_snapshot(payload, exception_info, pr_db, diff_provider):
+def save_snapshot(payload, exception_info, pr_db, diff_provider, outcome='error'):
     name = 'error-snapshot-%s' % int(round(time.time() * 1000))
     os.mkdir(name)
     with open(os.path.join(name, 'payload.json'), 'w') as f:
@@ -471,25 +676,70 @@ def save_snapshot(payload, exception_info, pr_db, diff_provider):
         f.write(json.dumps(pr_db, indent=2))
     with open(os.path.join(name, 'exception'), 'w') as f:
         f.write(''.join(exception_info))
+    with open(os.path.join(name, 'outcome'), 'w') as f:
+        f.write(outcome)
+    try:
+        pr_diff = diff_provider(payload['pull_request'])
+    except Exception as e:
+        # Fetching the diff may be what failed in the first place.
+        pr_diff = ''
+        print('could not fetch diff for snapshot: %s' % e)
     with open(os.path.join(name, 'pr.diff'), 'w') as f:
-        f.write(diff_provider(payload['pull_request']))
+        f.write(pr_diff)
     return name
 
 
+def _report_failure(payload, pr_db, provider, error_callback, outcome='error'):
+    exc_type, exc_value, exc_traceback = sys.exc_info()
+    info = traceback.format_exception(exc_type, exc_value, exc_traceback)
+    dir_name = save_snapshot(payload, info, pr_db, provider, outcome)
+    if error_callback:
+        error_callback(dir_name)
+    return False
+
+
+def _restore_forgotten(pr_db, orig_pr_db):
+    # Upstream PRs are forgotten while the steps are planned, before the steps
+    # that close or merge them have run. Upstream PRs opened by the steps that
+    # did run are kept.
+    for (pr_number, upstream) in orig_pr_db.items():
+        pr_db.setdefault(pr_number, upstream)
+
+
 def process_and_run_steps(config, pr_db, payload, provider, branch,
-                          step_callback=None, error_callback=None, pre_commit_callback=None):
+                          step_callback=None, error_callback=None, pre_commit_callback=None,
+                          cancel_token=None):
     orig_pr_db = copy.deepcopy(pr_db)
+    # Every git command and API request made while processing this event
+    # shares the event's overall deadline.
+    token = CancellationToken(cancel_token.cancelled if cancel_token else None,
+                              time.time() + config.get('event_timeout', EVENT_TIMEOUT))
+    step = None
     try:
-        steps = process_json_payload(config, pr_db, payload, provider, branch, pre_commit_callback)
-        for step in steps:
-            step.run(config)
+        with cancellable(token):
+            steps = process_json_payload(config, pr_db, payload, provider, branch, pre_commit_callback)
+            for step in steps:
+                check_cancelled()
+                with timed('step', step.name) as event:
+                    step.run(config)
+                    event['detail'] = step.name
+                if step_callback:
+                    step_callback(step)
+        return True
+    except TimedOut:
+        if step:
+            step.name += ':timed-out'
             if step_callback:
                 step_callback(step)
+        _restore_forgotten(pr_db, orig_pr_db)
+        return _report_failure(payload, orig_pr_db, provider, error_callback, 'timed out')
+    except Cancelled:
+        # A newer event for the same PR superseded this one and will redo its work.
+        print('cancelled sync of PR %s' % payload['pull_request']['number'])
+        _restore_forgotten(pr_db, orig_pr_db)
         return True
     except:
-        exc_type, exc_value, exc_traceback = sys.exc_info()
-        info = traceback.format_exception(exc_type, exc_value, exc_traceback)
-        dir_name = save_snapshot(payload, info, orig_pr_db, provider)
-        if error_callback:
-            error_callback(dir_name)
-        return False
+        # Keep the mapping so that a retry of this delivery (eg. from the
+        # spool) can still find the upstream PR.
+        _restore_forgotten(pr_db, orig_pr_db)
+        return _report_failure(payload, orig_pr_db, provider, error_callback)
@@ -1,19 +1,454 @@
+# -*- coding: utf-8 -*-
 import os
 import sys
 sys.path.append(os.path.abspath(os.path.dirname(__file__)))
 
+import admission
+import cancellation
+import circuit_breaker
 import copy
+import diff_cache
 from functools import partial
 import hook
 import json
+import merge_queue
+from recording import Recorder
+import replay
 import requests
+import shutil
+import spool
+import state
 import sync
+import test_api_server
 from sync import process_and_run_steps, UPSTREAMABLE_PATH, _upstream, git
 from test_api_server import start_server
 import threading
 import time
 import tempfile
 
+def wait_for_server(port):
+    # Wait for server to finish setting up before continuing
+    while True:
+        try:
+            r = requests.get('http://localhost:' + str(port) + '/ping')
+            assert(r.status_code == 200)
+            assert(r.text == 'pong')
+            break
+        except:
+            time.sleep(0.5)
+
+class APIServerThread(object):
+    def __init__(self, config, port):
+        #print('Starting API server on port ' + str(port))
+        self.port = port
+        thread = threading.Thread(target=self.run, args=(config,))
+        thread.daemon = True
+        thread.start()
+        wait_for_server(self.port)
+
+    def run(self, config):
+        start_server(self.port, config)
+
+    def shutdown(self):
+        r = requests.post('http://localhost:%d/shutdown' % self.port)
+        assert(r.status_code == 204)
+        # Wait for the server to stop responding to ping requests
+        while True:
+            try:
+                r = requests.get('http://localhost:' + str(port) + '/ping')
+                time.sleep(0.5)
+            except:
+                break
+        #print('Stopped API server on port ' + str(self.port))
+
+def test_parse_git_log():
+    repo = tempfile.mkdtemp()
+    git(["init", "-q"], cwd=repo)
+    expected = [
+        ("tmp author", "tmp@tmp.com", "tmp commit message"),
+        (u"Fernando Jiménez Moreno", "foo@bar.com", "Summary line\n\nA body spanning\nseveral lines.\n\nAnd a second paragraph."),
+        ("tmp author", "tmp@tmp.com", ""),
+    ]
+    for (author, email, message) in expected:
+        git(["commit", "-q", "--allow-empty", "--allow-empty-message",
+             "--author", "%s <%s>" % (author, email), "-m", message],
+            cwd=repo, env={'GIT_COMMITTER_NAME': 'tmp', 'GIT_COMMITTER_EMAIL': 'tmp@tmp.com'})
+    log = git(sync.COMMIT_LOG_ARGS + ["HEAD"], cwd=repo)
+    commits = sync._parse_git_log(log)
+    observed = [(c['commit']['author']['name'], c['commit']['author']['email'], c['commit']['message'])
+                for c in commits]
+    assert observed == expected, "%s != %s" % (observed, expected)
+    assert all(len(c['sha']) == 40 for c in commits)
+
+def test_git_log_order():
+    # x is dated after its children, and its sibling branch is dated before
+    # them, so ordering by date would list z1 before its parent x.
+    repo = tempfile.mkdtemp()
+    git(["init", "-q"], cwd=repo)
+    def commit(message, date, parents):
+        env = {'GIT_AUTHOR_NAME': 'tmp', 'GIT_AUTHOR_EMAIL': 'tmp@tmp.com',
+               'GIT_COMMITTER_NAME': 'tmp', 'GIT_COMMITTER_EMAIL': 'tmp@tmp.com',
+               'GIT_AUTHOR_DATE': '@%d +0000' % date, 'GIT_COMMITTER_DATE': '@%d +0000' % date}
+        tree = git(["write-tree"], cwd=repo).strip()
+        parent_args = sum([["-p", p] for p in parents], [])
+        return git(["commit-tree", tree, "-m", message] + parent_args, cwd=repo, env=env).strip()
+    base = commit("base", 1000000, [])
+    x = commit("x", 5000000, [base])
+    y = commit("y", 1000100, [x])
+    z1 = commit("z1", 1000040, [x])
+    z2 = commit("z2", 1000050, [z1])
+    merge = commit("merge", 1000200, [y, z2])
+    log = git(sync.COMMIT_LOG_ARGS + ["%s..%s" % (base, merge)], cwd=repo)
+    order = [c['commit']['message'] for c in sync._parse_git_log(log)]
+    assert order.index("x") < order.index("y") < order.index("merge"), order
+    assert order.index("x") < order.index("z1") < order.index("z2") < order.index("merge"), order
+
+def test_cancelled_upstream():
+    # A sync cancelled after a git command was killed must leave the WPT clone
+    # clean for the next one.
+    env = {'GIT_AUTHOR_NAME': 'tmp', 'GIT_AUTHOR_EMAIL': 'tmp@tmp.com',
+           'GIT_COMMITTER_NAME': 'tmp', 'GIT_COMMITTER_EMAIL': 'tmp@tmp.com'}
+    origin = tempfile.mkdtemp()
+    git(["init", "-q"], cwd=origin)
+    git(["symbolic-ref", "HEAD", "refs/heads/master"], cwd=origin)
+    git(["commit", "-q", "--allow-empty", "-m", "initial"], cwd=origin, env=env)
+    wpt_path = os.path.join(tempfile.mkdtemp(), 'wpt')
+    git(["clone", "-q", origin, wpt_path], cwd=origin)
+    commits = []
+    for name in ['a.html', 'b.html']:
+        diff = tempfile.TemporaryFile()
+        path = UPSTREAMABLE_PATH + name
+        diff.write(("diff --git a/%s b/%s\nnew file mode 100644\n--- /dev/null\n+++ b/%s\n"
+                    "@@ -0,0 +1 @@\n+%s\n" % (path, path, path, name)).encode('utf-8'))
+        commits += [{'diff': diff, 'message': name, 'author': 'tmp <tmp@tmp.com>'}]
+    token = cancellation.CancellationToken()
+    def kill_after_first_commit():
+        # What git add leaves behind when it is killed on cancellation.
+        open(os.path.join(wpt_path, '.git', 'index.lock'), 'w').close()
+        open(os.path.join(wpt_path, 'b.html'), 'w').close()
+        token.cancel()
+    config = {'wpt_path': wpt_path, 'suppress_force_push': True}
+    try:
+        with cancellation.cancellable(token):
+            _upstream(config, 1, commits, kill_after_first_commit)
+        assert False, "sync wasn't cancelled"
+    except cancellation.Cancelled:
+        pass
+    assert not os.path.exists(os.path.join(wpt_path, '.git', 'index.lock'))
+    assert git(["status", "--porcelain", "--ignored"], cwd=wpt_path) == ''
+    assert git(["rev-parse", "--abbrev-ref", "HEAD"], cwd=wpt_path).strip() == 'master'
+    assert git(["branch", "--list", "servo_export_1"], cwd=wpt_path) == ''
+
+    # A cancelled sync doesn't wait to fetch again before giving up.
+    def cancelled():
+        raise cancellation.Cancelled()
+    start = time.time()
+    try:
+        sync._retry_after_fetch(wpt_path, 'master', cancelled)
+        assert False, "Cancelled wasn't raised"
+    except cancellation.Cancelled:
+        pass
+    assert time.time() - start < 5
+
+def test_diff_cache():
+    env = {'GIT_AUTHOR_NAME': 'tmp', 'GIT_AUTHOR_EMAIL': 'tmp@tmp.com',
+           'GIT_COMMITTER_NAME': 'tmp', 'GIT_COMMITTER_EMAIL': 'tmp@tmp.com'}
+    servo_path = tempfile.mkdtemp()
+    git(["init", "-q"], cwd=servo_path)
+    shas = []
+    for path in [UPSTREAMABLE_PATH + 'a.html', 'components/a.rs']:
+        if not os.path.exists(os.path.join(servo_path, os.path.dirname(path))):
+            os.makedirs(os.path.join(servo_path, os.path.dirname(path)))
+        with open(os.path.join(servo_path, path), 'w') as f:
+            f.write('a\n')
+        git(["add", path], cwd=servo_path)
+        git(["commit", "-q", "-m", path], cwd=servo_path, env=env)
+        shas += [git(["rev-parse", "HEAD"], cwd=servo_path).strip()]
+    config = {'servo_path': servo_path, 'diff_cache_path': tempfile.mkdtemp()}
+    fetches = []
+    def fetch():
+        fetches.append(True)
+    def cached_diff(sha):
+        with sync.get_cached_filtered_diff_file(config, sha, fetch=fetch) as diff:
+            return diff.read()
+
+    (upstreamable, other) = [cached_diff(sha) for sha in shas]
+    assert b'+a' in upstreamable
+    assert other == b''
+    assert len(fetches) == 2
+    # Both diffs, including the one without upstreamable changes, are now
+    # served from the cache without fetching or running git.
+    config['servo_path'] = os.path.join(servo_path, 'missing')
+    assert [cached_diff(sha) for sha in shas] == [upstreamable, other]
+    assert len(fetches) == 2
+    assert diff_cache.read_cached_diff(config, shas[0], 'other/path/') is None
+
+    # The least recently used entry is evicted once the cache is over its limit.
+    config = {'diff_cache_path': tempfile.mkdtemp(), 'diff_cache_size': 5000}
+    def write(key):
+        diff = tempfile.TemporaryFile()
+        # Random data doesn't compress, so each entry takes up ~2000 bytes.
+        diff.write(os.urandom(2000))
+        diff_cache.write_cached_diff(config, key, UPSTREAMABLE_PATH, diff)
+        diff.close()
+    def age(key, seconds):
+        filename = diff_cache._cache_file(config, key, UPSTREAMABLE_PATH)
+        os.utime(filename, (time.time() - seconds, time.time() - seconds))
+    write('first')
+    age('first', 200)
+    write('second')
+    age('second', 100)
+    diff_cache.read_cached_diff(config, 'first', UPSTREAMABLE_PATH).close()
+    write('third')
+    cached = [key for key in ['first', 'second', 'third']
+              if diff_cache.read_cached_diff(config, key, UPSTREAMABLE_PATH) is not None]
+    assert cached == ['first', 'third'], cached
+
+def test_circuit_breaker():
+    port = 8901
+    server = APIServerThread({}, port)
+    api_config = test_api_server.config
+    config = {
+        'circuit_breaker': True,
+        'breaker_threshold': 2,
+        'breaker_cooldown': 0,
+        'state_path': tempfile.mkdtemp(),
+        'token': '',
+        'api': 'http://localhost:%d' % port,
+        'override_host': 'http://localhost:%d' % port,
+    }
+    # Only consecutive failures open the breaker.
+    circuit_breaker.record_failure(config)
+    circuit_breaker.record_success(config)
+    circuit_breaker.record_failure(config)
+    assert not circuit_breaker.breaker_open(config)
+    circuit_breaker.record_failure(config)
+    assert circuit_breaker.breaker_open(config)
+    assert spool.should_spool(config)
+    for n in [1, 2]:
+        spool.spool_delivery(config, {'pull_request': {'number': n}})
+
+    def unreachable(payload):
+        assert False, "replayed %s while GitHub was failing" % payload
+    # A failing health check keeps the breaker open.
+    api_config['rate_limit_status'] = 502
+    assert not spool.drain_spool(config, unreachable)
+    assert circuit_breaker.breaker_open(config)
+    api_config['rate_limit_status'] = 200
+
+    replayed = []
+    def still_failing(payload):
+        replayed.append(payload['pull_request']['number'])
+        # The health check succeeded, but pushing to the fork doesn't.
+        circuit_breaker.record_success(config)
+        circuit_breaker.record_failure(config)
+        return False
+    assert not spool.drain_spool(config, still_failing)
+    assert circuit_breaker.breaker_open(config)
+    assert len(spool.spooled_deliveries(config)) == 2
+
+    def recovered(payload):
+        replayed.append(payload['pull_request']['number'])
+        # Half-open: other successful requests don't close the breaker, and new
+        # deliveries still wait behind the spooled ones.
+        circuit_breaker.record_success(config)
+        assert not circuit_breaker.breaker_open(config)
+        assert circuit_breaker._tripped(config, circuit_breaker._breaker_state(config))
+        assert spool.should_spool(config)
+        return True
+    assert spool.drain_spool(config, recovered)
+    assert not circuit_breaker._tripped(config, circuit_breaker._breaker_state(config))
+    assert len(spool.spooled_deliveries(config)) == 1
+
+    # Once closed, a delivery that fails for other reasons is reported and
+    # dropped like any other.
+    def broken(payload):
+        replayed.append(payload['pull_request']['number'])
+        return False
+    assert spool.drain_spool(config, broken)
+    assert spool.spooled_deliveries(config) == []
+    assert replayed == [1, 1, 2], replayed
+    server.shutdown()
+
+def test_merge_queue():
+    port = 8900
+    api_config = {
+        'upstream_prs': {},
+        'statuses': {},
+        'merge_status': 204,
+        'requests': [],
+    }
+    server = APIServerThread(api_config, port)
+    # Responses are changed between checks through the server's own config.
+    api_config = test_api_server.config
+    queue_config = {
+        'upstream_org': 'jdm',
+        'token': '',
+        'api': 'http://localhost:%d' % port,
+        'override_host': 'http://localhost:%d' % port,
+        'state_path': tempfile.mkdtemp(),
+        'merge_queue_interval': 60,
+        'merge_queue_attempts': 2,
+        'merge_queue_timeout': 3600,
+    }
+    pulls = '/repos/jdm/web-platform-tests/pulls/'
+    issues = '/repos/jdm/web-platform-tests/issues/'
+    status = '/repos/jdm/web-platform-tests/commits/%s/status'
+
+    def queue_pr(number, mergeable_state, sha, merged=False):
+        api_config['upstream_prs'][str(number)] = {
+            'state': 'closed' if merged else 'open',
+            'merged': merged,
+            'mergeable_state': mergeable_state,
+            'head': {'sha': sha},
+        }
+        state.enqueue_merge(queue_config, number)
+
+    def check(now, expected_requests, expected_queue):
+        del api_config['requests'][:]
+        merge_queue.process_merge_queue(queue_config, now)
+        assert api_config['requests'] == expected_requests, \
+            "%s != %s" % (api_config['requests'], expected_requests)
+        queued = sorted(state.read_merge_queue(queue_config).keys())
+        assert queued == expected_queue, "%s != %s" % (queued, expected_queue)
+
+    # Later than any of the entries queued below.
+    now = time.time() + 10
+    # A PR waiting for CI is checked with conditional requests until it passes.
+    queue_pr(45, 'blocked', 'abc')
+    check(now, ['GET %s45 200' % pulls, 'GET %s 200' % (status % 'abc')], ['45'])
+    check(now, [], ['45'])
+    check(now + 60, ['GET %s45 304' % pulls, 'GET %s 304' % (status % 'abc')], ['45'])
+    api_config['upstream_prs']['45']['mergeable_state'] = 'clean'
+    api_config['statuses']['abc'] = 'success'
+    check(now + 120, ['GET %s45 200' % pulls,
+                      'DELETE %s45/labels/do not merge yet 204' % issues,
+                      'PUT %s45/merge 204' % pulls], [])
+
+    # Failing CI is left for a human.
+    queue_pr(46, 'blocked', 'def')
+    api_config['statuses']['def'] = 'failure'
+    check(now, ['GET %s46 200' % pulls, 'GET %s 200' % (status % 'def'),
+                'POST %s46/labels 204' % issues, 'POST %s46/comments 204' % issues], [])
+
+    # So is a PR that can't be merged after merge_queue_attempts tries.
+    api_config['merge_status'] = 405
+    queue_pr(47, 'clean', 'ghi')
+    check(now, ['GET %s47 200' % pulls,
+                'DELETE %s47/labels/do not merge yet 204' % issues,
+                'PUT %s47/merge 405' % pulls], ['47'])
+    check(now + 60, ['GET %s47 304' % pulls,
+                     'DELETE %s47/labels/do not merge yet 204' % issues,
+                     'PUT %s47/merge 405' % pulls,
+                     'POST %s47/labels 204' % issues, 'POST %s47/comments 204' % issues], [])
+    api_config['merge_status'] = 204
+
+    # And one whose CI doesn't finish within merge_queue_timeout.
+    queue_pr(48, 'blocked', 'jkl')
+    check(now + 3601, ['GET %s48 200' % pulls, 'GET %s 200' % (status % 'jkl'),
+                       'POST %s48/labels 204' % issues, 'POST %s48/comments 204' % issues], [])
+
+    # A PR merged by someone else is forgotten.
+    queue_pr(49, 'clean', 'mno', merged=True)
+    check(now, ['GET %s49 200' % pulls], [])
+
+    server.shutdown()
+
+def test_merge_queue_pokes():
+    # A poke that arrives while a queued merge is being checked isn't lost.
+    checked = {'next_check': 160, 'attempts': 1, 'pokes': 0}
+    assert merge_queue._merge_checked_entry(checked, 0, {'next_check': 0, 'pokes': 1}) == \
+        {'next_check': 0, 'attempts': 1, 'pokes': 1}
+    assert merge_queue._merge_checked_entry(checked, 0, {'next_check': 100, 'pokes': 0}) == checked
+    assert merge_queue._merge_checked_entry(None, 0, {'next_check': 0, 'pokes': 1}) is None
+
+def hold_admissions(controller, events):
+    """Hold the controller's only slot with a blocking event and queue the
+    given (event class, PR number[, cost]) events in order. Returns a function
+    that lets them all run and returns the order in which they were admitted."""
+    admitted = []
+    release = threading.Event()
+    def deliver(event_class, pr_number, cost=1):
+        with controller.admitted(event_class, pr_number, cost):
+            admitted.append((event_class, pr_number))
+            if pr_number is None:
+                release.wait()
+    threads = [threading.Thread(target=deliver, args=('push', None))]
+    threads[0].start()
+    while not admitted:
+        time.sleep(0.01)
+    for (i, event) in enumerate(events):
+        threads.append(threading.Thread(target=deliver, args=event))
+        threads[-1].start()
+        while controller.stats()['queued'] <= i:
+            time.sleep(0.01)
+    def finish():
+        release.set()
+        for thread in threads:
+            thread.join()
+        return admitted[1:]
+    return finish
+
+def test_admission():
+    # More valuable events go first, but never ahead of an earlier event for
+    # the same PR; that event is promoted instead.
+    controller = admission.AdmissionController({'max_in_flight': 1})
+    order = hold_admissions(controller, [('push', 8), ('push', 7), ('merge', 7), ('close', 9)])()
+    assert order == [('push', 7), ('merge', 7), ('close', 9), ('push', 8)], order
+
+    # Less valuable events are shed first as the queue fills up, and every
+    # event once it is full.
+    pushes = [('push', 1), ('push', 2), ('push', 3)]
+    for (queued, shed, expected) in [
+            (pushes, [('edit', False), ('push', False)], pushes),
+            (pushes + [('merge', 4)], [('edit', True), ('merge', True)], [('merge', 4)] + pushes)]:
+        controller = admission.AdmissionController({'max_in_flight': 1, 'max_queued': 4})
+        finish = hold_admissions(controller, queued)
+        for (event_class, full) in shed:
+            try:
+                with controller.admitted(event_class, 5):
+                    pass
+                raise AssertionError('%s event was not shed' % event_class)
+            except admission.Saturated as e:
+                assert e.full == full, event_class
+        order = finish()
+        assert order == expected, order
+
+def test_admission_fairness():
+    # Within a class, a PR with many queued events doesn't hold up the others.
+    controller = admission.AdmissionController({'max_in_flight': 1})
+    finish = hold_admissions(controller, [('push', 1), ('push', 1), ('push', 1),
+                                          ('push', 2), ('push', 3), ('close', 4)])
+    stats = controller.stats()['wait']
+    assert (stats['push']['queued'], stats['close']['queued']) == (5, 1), stats
+    order = finish()
+    assert order == [('close', 4), ('push', 1), ('push', 2), ('push', 3), ('push', 1), ('push', 1)], order
+    stats = controller.stats()['wait']
+    # Including the event that held the slot.
+    assert (stats['push']['admitted'], stats['close']['admitted'], stats['merge']['admitted']) == (6, 1, 0), stats
+    assert stats['push']['queued'] == 0
+    assert stats['push']['max'] >= stats['push']['mean'] > 0
+    assert stats['merge']['mean'] == stats['merge']['max'] == 0
+
+    # Pushes are weighted by their number of commits.
+    controller = admission.AdmissionController({'max_in_flight': 1})
+    order = hold_admissions(controller, [('push', 5, 10), ('push', 6, 1)])()
+    assert order == [('push', 6), ('push', 5)], order
+    assert admission.cost({'action': 'synchronize', 'pull_request': {'commits': 10}}, 'push') == 10
+    assert admission.cost({'action': 'synchronize', 'pull_request': {'commits': 500}}, 'push') == admission.MAX_PUSH_COST
+    assert admission.cost({'action': 'edited', 'pull_request': {'commits': 10}}, 'edit') == 1
+
+test_parse_git_log()
+test_git_log_order()
+test_cancelled_upstream()
+test_diff_cache()
+test_circuit_breaker()
+test_merge_queue_pokes()
+test_merge_queue()
+test_admission()
+test_admission_fairness()
+print("Successfully ran unit tests.")
+
 base_wpt_dir = tempfile.mkdtemp()
 git(["clone", "--depth=1", "https://github.com/jdm/web-platform-tests-mock.git"], cwd=base_wpt_dir)
 git(["clone", "--depth=1", "https://github.com/jdm/servo-mock.git"], cwd=base_wpt_dir)
@@ -48,47 +483,11 @@ with open('git_tests.json') as f:
     git_tests = json.loads(f.read())
 for test in git_tests:
     for commit in test['commits']:
-        with open(commit['diff']) as f:
-            commit['diff'] = f.read()
+        commit['diff'] = open(commit['diff'], 'rb')
     pr_number = test['pr_number']
     _upstream(config, pr_number, test['commits'], None, partial(git_callback, test))
 print("Successfully ran git upstreaming tests.")
 
-def wait_for_server(port):
-    # Wait for server to finish setting up before continuing
-    while True:
-        try:
-            r = requests.get('http://localhost:' + str(port) + '/ping')
-            assert(r.status_code == 200)
-            assert(r.text == 'pong')
-            break
-        except:
-            time.sleep(0.5)
-
-class APIServerThread(object):
-    def __init__(self, config, port):
-        #print('Starting API server on port ' + str(port))
-        self.port = port
-        thread = threading.Thread(target=self.run, args=(config,))
-        thread.daemon = True
-        thread.start()
-        wait_for_server(self.port)
-
-    def run(self, config):
-        start_server(self.port, config)
-
-    def shutdown(self):
-        r = requests.post('http://localhost:%d/shutdown' % self.port)
-        assert(r.status_code == 204)
-        # Wait for the server to stop responding to ping requests
-        while True:
-            try:
-                r = requests.get('http://localhost:' + str(port) + '/ping')
-                time.sleep(0.5)
-            except:
-                break
-        #print('Stopped API server on port ' + str(self.port))
-
 def pr_diff_files(test, pull_request):
     def fake_commit_data(filename):
         return [filename, "tmp author", "tmp@tmp.com", "tmp commit message"]
@@ -119,18 +518,30 @@ def make_api_config(test, payload, servo_path):
     api_config = {
         "diff_files": pr_diff_files(test, payload["pull_request"]),
         "servo_path": servo_path,
+        "graphql_status": 200,
+        "requests": [],
     }
     api_config.update(test.get('api_config', {}))
     return api_config
 
+def check_requests(test, served):
+    # Each request is recorded as "METHOD path status".
+    served = [r.rsplit(' ', 1)[0] for r in served]
+    for expected in test.get('requests', []):
+        assert expected in served, "%s not in %s" % (expected, served)
+    for unexpected in test.get('unexpected_requests', []):
+        assert unexpected not in served, "%s in %s" % (unexpected, served)
+
 for (i, test) in enumerate(filter(lambda x: not x.get('disabled', False), tests)):
     with open(os.path.join('tests', test['payload'])) as f:
         payload = json.loads(f.read())
 
     port = 9000 + i
-    config['api'] = 'http://localhost:' + str(port)
-    config['override_host'] = config['api']
-    server = APIServerThread(make_api_config(test, payload, config['servo_path']), port)
+    test_config = dict(config, **test.get('config', {}))
+    test_config['api'] = 'http://localhost:' + str(port)
+    test_config['override_host'] = test_config['api']
+    api_config = make_api_config(test, payload, config['servo_path'])
+    server = APIServerThread(api_config, port)
 
     print(test['name'] + ':'),
     executed = []
@@ -149,8 +560,8 @@ for (i, test) in enumerate(filter(lambda x: not x.get('disabled', False), tests)
         expected = "%s %s %s" % (commit[1], commit[2], commit[3])
         assert last_commit == expected, "%s != %s" % (last_commit, expected)
     commits = pr_diff_files(test, payload['pull_request'])
-    result = process_and_run_steps(config,
-                                   test['db'],
+    result = process_and_run_steps(test_config,
+                                   copy.deepcopy(test['db']),
                                    payload,
                                    partial(get_pr_diff, test),
                                    "master",
@@ -158,6 +569,7 @@ for (i, test) in enumerate(filter(lambda x: not x.get('disabled', False), tests)
                                    error_callback=error_callback,
                                    pre_commit_callback=partial(pre_commit_callback, commits))
     server.shutdown()
+    check_requests(test, api_config['requests'])
     if result and all(map(lambda values: values[0] == values[1]
                           if ':' not in values[1] else values[0].startswith(values[1]),
                zip(executed, test['expected']))):
@@ -169,17 +581,55 @@ for (i, test) in enumerate(filter(lambda x: not x.get('disabled', False), tests)
         print(test['expected'])
         assert(executed == test['expected'])
 
+def test_record_replay():
+    # Record syncs against the test API server, then replay each capture
+    # offline and check that it runs the same steps with the same result.
+    port = 9100
+    for test in tests:
+        if test['name'] not in ["open new upstreamable PR", "merge upstreamed PR"]:
+            continue
+        for graphql in [False, True]:
+            with open(os.path.join('tests', test['payload'])) as f:
+                payload = json.loads(f.read())
+            port += 1
+            test_config = dict(config, graphql=graphql)
+            test_config['api'] = 'http://localhost:' + str(port)
+            test_config['override_host'] = test_config['api']
+            api_config = make_api_config(test, payload, config['servo_path'])
+            server = APIServerThread(api_config, port)
+
+            executed = []
+            recorder = Recorder(test_config)
+            db = copy.deepcopy(test['db'])
+            run = partial(process_and_run_steps, test_config, db, payload,
+                          recorder.provider(partial(get_pr_diff, test)), "master",
+                          step_callback=lambda step: executed.append(step.name))
+            result = recorder.record(payload, db, "master", run)
+            server.shutdown()
+            assert result, test['name']
+            if graphql:
+                assert "POST /graphql 200" in api_config['requests'], api_config['requests']
+
+            report = replay.replay_capture(recorder.dir_name)
+            replayed = [name for (name, _) in report['steps']]
+            assert report['result'], report
+            assert replayed == executed, "%s != %s" % (replayed, executed)
+            shutil.rmtree(recorder.dir_name)
+    print("Successfully replayed recorded syncs.")
+
+test_record_replay()
+
 class ServerThread(object):
-    def __init__(self, config):
+    def __init__(self, config, pr_db):
         #print('Starting server thread on port ' + str(config['port']))
         self.port = config['port']
-        thread = threading.Thread(target=self.run, args=(config,))
+        thread = threading.Thread(target=self.run, args=(config, pr_db))
         thread.daemon = True
         thread.start()
         wait_for_server(config['port'])
 
-    def run(self, config):
-        hook.main(config, {})
+    def run(self, config, pr_db):
+        hook.main(config, pr_db)
 
     def shutdown(self):
         r = requests.post('http://localhost:%d/shutdown' % self.port)
@@ -192,16 +642,18 @@ for (i, test) in enumerate(tests):
     print(test['name'] + ':'),
 
     this_config = copy.deepcopy(config)
+    this_config.update(test.get('config', {}))
     this_config['port'] += i
     port += i
     this_config['api'] = 'http://localhost:' + str(port)
     this_config['override_host'] = this_config['api']
-    server = ServerThread(this_config)
+    server = ServerThread(this_config, copy.deepcopy(test['db']))
 
     with open(os.path.join('tests', test['payload'])) as f:
         payload = f.read()
 
-    api_server = APIServerThread(make_api_config(test, json.loads(payload), config['servo_path']), port)
+    api_config = make_api_config(test, json.loads(payload), config['servo_path'])
+    api_server = APIServerThread(api_config, port)
 
     r = requests.post('http://localhost:' + str(this_config['port']) + '/test', data={'payload': payload})
     if r.status_code != 204:
@@ -209,5 +661,6 @@ for (i, test) in enumerate(tests):
     assert(r.status_code == 204)
     server.shutdown()
     api_server.shutdown()
+    check_requests(test, api_config['requests'])
 
     print('passed')
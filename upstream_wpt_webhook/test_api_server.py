@@ -1,4 +1,5 @@
 from flask import Flask, request, jsonify, render_template, make_response, abort
+import hashlib
 import json
 import locale
 import os
@@ -15,6 +16,14 @@ config = {
     'servo_path': None,
     'diff_files': None,
     'upstreamable': {},
+    # Upstream PRs and commit statuses, by number and sha, for the merge queue.
+    'upstream_prs': {},
+    'statuses': {},
+    'merge_status': 204,
+    'graphql_status': 200,
+    'rate_limit_status': 200,
+    # Every request served, as "METHOD path status".
+    'requests': [],
 }
 
 def start_server(port, _config):
@@ -34,6 +43,18 @@ def shutdown():
 def ping():
     return ('pong', 200)
 
+@app.after_request
+def record_request(response):
+    config['requests'].append('%s %s %d' % (request.method, request.path, response.status_code))
+    return response
+
+def conditional(data):
+    body = json.dumps(data)
+    etag = '"%s"' % hashlib.sha1(body.encode('utf-8')).hexdigest()
+    if request.headers.get('If-None-Match') == etag:
+        return ('', 304, {'ETag': etag})
+    return (body, 200, {'ETag': etag})
+
 def commits():
     def make_commit(diff_file):
         this_dir = os.path.abspath(os.path.dirname(__file__))
@@ -82,6 +103,30 @@ def new_pull_request():
         "html_url": "http://path/to/pull/45",
     }
 
+def graphql_response(query, variables):
+    data = {}
+    if 'repository(' in query:
+        repository = {"id": "R_wpt"}
+        if variables.get('withPr'):
+            repository["pullRequest"] = {"id": "PR_%s" % variables['number']}
+        for (name, value) in variables.items():
+            if name.startswith('label'):
+                repository[name] = {"id": "L_%s" % value}
+        data["repository"] = repository
+    if 'createPullRequest(' in query:
+        pull_request = new_pull_request()
+        data["createPullRequest"] = {
+            "pullRequest": {
+                "id": "PR_%s" % pull_request["number"],
+                "number": pull_request["number"],
+                "url": pull_request["html_url"],
+            },
+        }
+    for mutation in ['addLabelsToLabelable', 'removeLabelsFromLabelable', 'mergePullRequest']:
+        if mutation + '(' in query:
+            data[mutation] = {"clientMutationId": None}
+    return {"data": data}
+
 @app.route("/", defaults={'path': ''})
 @app.route("/<path:path>", methods=["POST","PATCH","GET", "DELETE", "PUT"])
 def catch_all(path):
@@ -90,10 +135,23 @@ def catch_all(path):
     elif 'commit_metadata/' in path:
         sha = path.split('/')[-1]
         return (json.dumps(commit_with_single_file(config['upstreamable'][sha])), 200)
+    elif path == 'graphql':
+        if config['graphql_status'] != 200:
+            return ('GraphQL unavailable', config['graphql_status'])
+        body = request.get_json()
+        return (json.dumps(graphql_response(body['query'], body.get('variables', {}))), 200)
+    elif path == 'rate_limit':
+        return (json.dumps({"resources": {}}), config['rate_limit_status'])
     elif path.endswith('pulls'):
         return (json.dumps(new_pull_request()), 200)
     elif path.endswith('merge'):
+        if config['merge_status'] != 204:
+            return (json.dumps({"message": "Pull Request is not mergeable"}), config['merge_status'])
         return ('', 204)
+    elif '/pulls/' in path and request.method == 'GET' and path.split('/')[-1] in config['upstream_prs']:
+        return conditional(config['upstream_prs'][path.split('/')[-1]])
+    elif path.endswith('/status') and request.method == 'GET':
+        return conditional({"state": config['statuses'].get(path.split('/')[-2], 'pending')})
     elif '/pulls/' in path:
         return ('', 204)
     elif '/labels/' in path or path.endswith('/labels'):
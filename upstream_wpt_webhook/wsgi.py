@@ -0,0 +1,17 @@
+# Entry point for multi-worker WSGI servers, eg.
+#   gunicorn --workers 4 --worker-class gthread --threads 40 --timeout 1900 \
+#       upstream_wpt_webhook.wsgi:application
+# Syncs run inside the request and can take up to event_timeout seconds, so the
+# worker needs threads and a timeout longer than that; admission limits such as
+# max_in_flight apply to each worker separately.
+# Every worker shares the PR database and per-PR locks under config['state_path'].
+
+import os
+import sys
+sys.path.append(os.path.abspath(os.path.dirname(__file__)))
+
+import hook
+
+hook.start_background(hook.read_config())
+
+application = hook.app